@@ -0,0 +1,68 @@
+from datetime import datetime
+
+import pyarrow as pa
+
+from bigquery_schemas import schemas
+
+ARROW_TYPES = {
+    "INTEGER": pa.int64(),
+    "FLOAT": pa.float64(),
+    "STRING": pa.string(),
+    "DATE": pa.date32(),
+    "BOOLEAN": pa.bool_(),
+}
+
+
+def _to_date(value):
+    return value.date() if isinstance(value, datetime) else value
+
+
+# pg8000 returns NUMERIC (EXTRACT, 1.0/count(*), ...) as Decimal, which Arrow
+# will not cast to the integer and float columns declared in the schemas.
+COERCIONS = {
+    "INTEGER": int,
+    "FLOAT": float,
+    "STRING": str,
+    "DATE": _to_date,
+    "BOOLEAN": bool,
+}
+
+
+def arrow_schema(table_name):
+    return pa.schema(
+        [pa.field(field.name, ARROW_TYPES[field.field_type]) for field in schemas[table_name]]
+    )
+
+
+def to_array(values, field_type):
+    arrow_type = ARROW_TYPES[field_type]
+    try:
+        return pa.array(values, type=arrow_type)
+    except (pa.ArrowInvalid, pa.ArrowTypeError, TypeError):
+        coerce = COERCIONS[field_type]
+        return pa.array([None if value is None else coerce(value) for value in values], type=arrow_type)
+
+
+# columns maps column names to lists of values, e.g. the transposed rows of
+# one fetch; columns the query did not return come out as nulls.
+def record_batch_from_columns(columns, table_name, schema=None, num_rows=None):
+    schema = schema or arrow_schema(table_name)
+    if num_rows is None:
+        num_rows = len(next(iter(columns.values()), []))
+    arrays = [
+        to_array(columns.get(field.name, [None] * num_rows), field.field_type)
+        for field in schemas[table_name]
+    ]
+    return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+
+def record_batch_from_tuples(keys, rows, table_name, schema=None):
+    columns = dict(zip(keys, zip(*rows))) if rows else {}
+    return record_batch_from_columns(
+        {name: list(values) for name, values in columns.items()}, table_name, schema, len(rows)
+    )
+
+
+def to_record_batch(rows, table_name, schema=None):
+    columns = {field.name: [row.get(field.name) for row in rows] for field in schemas[table_name]}
+    return record_batch_from_columns(columns, table_name, schema, len(rows))
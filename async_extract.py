@@ -0,0 +1,168 @@
+import asyncio
+import queue
+import re
+import threading
+import time
+
+import apache_beam as beam
+
+from arrow_schemas import record_batch_from_tuples
+from derivations import raw_record_batch
+from run_metrics import counter
+
+_DONE = object()
+
+# :name bind parameters, but not the second colon of a ::type cast.
+_BIND_PARAM = re.compile(r"(?<![:\w]):([A-Za-z_]\w*)")
+
+
+def to_positional(sql, params):
+    """Rewrites :name parameters to asyncpg's $1, $2, ... and returns the arguments."""
+    names = []
+
+    def replace(match):
+        if match.group(1) not in names:
+            names.append(match.group(1))
+        return f"${names.index(match.group(1)) + 1}"
+
+    return _BIND_PARAM.sub(replace, sql), [params[name] for name in names]
+
+
+# Runs (table_name, (sql, params)) jobs on an asyncio event loop in a background
+# thread, at most max_concurrency queries at a time, each streamed through a
+# server-side cursor fetch_size rows at a time. Fetched partitions go through
+# a queue of queue_size entries: once the consumer falls behind, the queries
+# stop fetching until it catches up.
+class AsyncExtractor:
+    def __init__(self, connection_factory, max_concurrency=8, fetch_size=10000, queue_size=8):
+        self.connection_factory = connection_factory
+        self.max_concurrency = max_concurrency
+        self.fetch_size = fetch_size
+        self.queue_size = queue_size
+        # Seconds spent waiting on fetches per table during the last
+        # partitions() call.
+        self.fetch_seconds = {}
+
+    def partitions(self, jobs):
+        """Yields (table_name, keys, rows) in the order the fetches complete."""
+        out = queue.Queue(maxsize=self.queue_size)
+        stop = threading.Event()
+        self.fetch_seconds = {}
+
+        def produce():
+            try:
+                asyncio.run(self._run(jobs, out, stop))
+            except BaseException as e:
+                out.put(e)
+            else:
+                out.put(_DONE)
+
+        thread = threading.Thread(target=produce, name="async-extract", daemon=True)
+        thread.start()
+        try:
+            while True:
+                item = out.get()
+                if item is _DONE:
+                    return
+                if isinstance(item, BaseException):
+                    raise item
+                yield item
+        finally:
+            # The consumer stopped early: let blocked producers finish.
+            stop.set()
+            while thread.is_alive():
+                try:
+                    out.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+
+    async def _run(self, jobs, out, stop):
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        idle = []
+        # Prepared statements per (connection, SQL text); shards of a table
+        # share the text and only differ in their arguments.
+        statements = {}
+        try:
+            tasks = [
+                asyncio.create_task(
+                    self._extract(table_name, query, semaphore, idle, statements, out, stop)
+                )
+                for table_name, query in jobs
+            ]
+            try:
+                await asyncio.gather(*tasks)
+            except BaseException:
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+                raise
+        finally:
+            for conn in idle:
+                await conn.close()
+            await self.connection_factory.close_async()
+
+    async def _extract(self, table_name, query, semaphore, idle, statements, out, stop):
+        async with semaphore:
+            # At most max_concurrency connections exist, reused across jobs.
+            conn = idle.pop() if idle else await self.connection_factory.connect_async()
+            try:
+                print(f"Processing data from {table_name}", flush=True)
+                sql, args = to_positional(*query)
+                statement = statements.get((conn, sql))
+                if statement is None:
+                    statement = statements[conn, sql] = await conn.prepare(sql)
+                async with conn.transaction(readonly=True):
+                    cursor = await statement.cursor(*args)
+                    while not stop.is_set():
+                        started = time.perf_counter()
+                        rows = await cursor.fetch(self.fetch_size)
+                        self.fetch_seconds[table_name] = (
+                            self.fetch_seconds.get(table_name, 0) + time.perf_counter() - started
+                        )
+                        if not rows:
+                            break
+                        keys = list(rows[0].keys())
+                        await asyncio.to_thread(out.put, (table_name, keys, [tuple(row) for row in rows]))
+            except BaseException:
+                for key in [key for key in statements if key[0] is conn]:
+                    del statements[key]
+                await conn.close()
+                raise
+            idle.append(conn)
+
+
+# Runs a whole list of (table_name, (sql, params)) jobs concurrently and emits every
+# table's rows on the tagged output named after the table.
+class ReadFromPostgresAsync(beam.DoFn):
+    def __init__(
+        self,
+        connection_factory,
+        max_concurrency=8,
+        fetch_size=10000,
+        output_format="rows",
+        raw_tables=(),
+    ):
+        self.connection_factory = connection_factory
+        self.max_concurrency = max_concurrency
+        self.fetch_size = fetch_size
+        self.output_format = output_format
+        self.raw_tables = raw_tables
+
+    def setup(self):
+        self.extractor = AsyncExtractor(
+            self.connection_factory, max_concurrency=self.max_concurrency, fetch_size=self.fetch_size
+        )
+
+    def process(self, jobs):
+        for table_name, keys, rows in self.extractor.partitions(jobs):
+            counter(table_name, "extract", "rows").inc(len(rows))
+            if table_name in self.raw_tables:
+                yield beam.pvalue.TaggedOutput(table_name, raw_record_batch(keys, rows))
+                continue
+            if self.output_format == "batches":
+                yield beam.pvalue.TaggedOutput(table_name, record_batch_from_tuples(keys, rows, table_name))
+                continue
+            for row in rows:
+                yield beam.pvalue.TaggedOutput(table_name, dict(zip(keys, row)))
+        for table_name, seconds in self.extractor.fetch_seconds.items():
+            counter(table_name, "extract", "fetch_ms").inc(int(seconds * 1000))
@@ -0,0 +1,243 @@
+"""Historical backfill in bounded, resumable date windows.
+
+    python backfill.py --start 2018-01-01 --end 2024-06-01 --window-months 1 --concurrency 2 --windows-per-minute 6
+
+Fact tables are extracted in windows on loaned_at / rated_at / listed_at,
+dimensions in one piece. Every window is its own Beam pipeline writing
+Parquet files under its own prefix, at most --concurrency at a time and at
+most --windows-per-minute started against Postgres. Finished windows are
+recorded in the state store, so rerunning the same command continues an
+interrupted backfill. Once everything is extracted the dimensions get one
+load job and one MERGE each. The windowed tables get one load of all their
+windows, which keeps only the latest window's row of a PK extracted in
+several windows (a work re-rated months later) as incremental runs would,
+and one MERGE each. Loads and merges are recorded per table, so a rerun
+after an interruption only repeats those that did not finish.
+
+The backfill uses the staging dataset, so don't run it while run_pipeline is
+running.
+"""
+import argparse
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import date
+
+import apache_beam as beam
+
+from file_sink import delete_staged_files, staged_files
+from fingerprints import FingerprintStore
+from main import DataPipeline
+from table_registry import TABLES
+from watermarks import DEFAULT_START, WATERMARK_COLUMNS, probe_watermark
+
+WINDOWED_TABLES = ("return_fact", "rating_fact", "listing_fact")
+
+
+def month_windows(start: date, end: date, months=1):
+    windows = []
+    lo = start
+    while lo < end:
+        month = lo.month - 1 + months
+        hi = min(date(lo.year + month // 12, month % 12 + 1, 1), end)
+        windows.append((lo.isoformat(), hi.isoformat()))
+        lo = hi
+    return windows
+
+
+class RateLimiter:
+    def __init__(self, per_minute=None):
+        self.interval = 60.0 / per_minute if per_minute else 0.0
+        self._next = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next)
+            self._next = start + self.interval
+        time.sleep(start - now)
+
+
+class Backfill:
+    def __init__(
+        self,
+        pipeline: DataPipeline,
+        start: date,
+        end: date,
+        window_months=1,
+        concurrency=2,
+        windows_per_minute=None,
+    ):
+        if pipeline.sink == "streaming_inserts":
+            raise ValueError("Backfill stages files per window, use sink=\"file_loads\"")
+        self.pipeline = pipeline
+        # Facts past `end` are left to the next incremental run, so `end`
+        # becomes their watermark and must not lie in the future.
+        self.start = start
+        self.end = min(end, date.today())
+        self.windows = month_windows(self.start, self.end, window_months)
+        self.concurrency = concurrency
+        self.limiter = RateLimiter(windows_per_minute)
+
+        self.backfill_id = f"{self.start}_{self.end}_{window_months}m"
+        self.prefix = f"{pipeline.staging_path}/backfill/{self.backfill_id}"
+        self.progress_name = f"backfill/{self.backfill_id}.json"
+        self.progress = pipeline.state_store.read(
+            self.progress_name, default={"extracted": [], "merged": [], "watermarks": None}
+        )
+        self._lock = threading.Lock()
+
+    def save_progress(self):
+        self.pipeline.state_store.write(self.progress_name, self.progress)
+
+    def windowed(self, table_name):
+        return table_name in WINDOWED_TABLES or (
+            table_name == "date" and self.pipeline.date_source == "query"
+        )
+
+    def tasks(self, tables):
+        for table_name in tables:
+            if self.windowed(table_name):
+                for lo, hi in self.windows:
+                    yield table_name, lo, hi
+            else:
+                yield table_name, DEFAULT_START, "infinity"
+
+    def window_prefix(self, table_name, lo, hi):
+        return f"{self.prefix}/{table_name}/{lo}_{hi}"
+
+    def get_watermarks(self, tables):
+        watermarks = {}
+        with self.pipeline.source_connection() as conn:
+            for table_name in tables:
+                if self.windowed(table_name):
+                    watermarks[table_name] = self.end.isoformat()
+                elif table_name in WATERMARK_COLUMNS and table_name != "date":
+                    watermark = probe_watermark(conn, table_name, DEFAULT_START)
+                    if watermark is not None:
+                        watermarks[table_name] = str(watermark)
+        return watermarks
+
+    def extract(self, table_name, lo, hi):
+        self.limiter.wait()
+        prefix = self.window_prefix(table_name, lo, hi)
+        # Files of an interrupted attempt at this window.
+        delete_staged_files(prefix)
+        started = time.monotonic()
+        p = beam.Pipeline(options=self.pipeline.pipeline_options)
+        self.pipeline.create_pipeline(table_name, lo, p, end_date=hi, staging_prefix=prefix)
+        p.run().wait_until_finish()
+        with self._lock:
+            self.progress["extracted"].append(f"{table_name}/{lo}_{hi}")
+            self.save_progress()
+        return time.monotonic() - started
+
+    def load(self, table_name):
+        # Every window of a windowed table goes into one staging load, where
+        # a row extracted in several windows keeps its latest version.
+        if self.windowed(table_name):
+            windows = [staged_files(self.window_prefix(table_name, lo, hi)) for lo, hi in self.windows]
+            files = sum(windows, [])
+            job = self.pipeline.warehouse.load_windows(table_name, windows)
+        else:
+            files = staged_files(self.window_prefix(table_name, DEFAULT_START, "infinity"))
+            job = self.pipeline.warehouse.load_files(table_name, files)
+        table_id = self.pipeline.warehouse.table_id(table_name, staging=True)
+        print(f"Loaded {len(files)} files into {table_id}", flush=True)
+        if job is not None:
+            job.result()
+
+    def merge(self, tables):
+        names = [
+            name for name in [*tables, *self.pipeline.rollups_for(tables)] if name not in self.progress["merged"]
+        ]
+        for table_name in tables:
+            # A rollup is refreshed from its fact's staged rows even when
+            # the fact itself was merged before an interruption.
+            if {table_name, *self.pipeline.rollups_for([table_name])} & set(names):
+                self.load(table_name)
+
+        def merged(name, job):
+            with self._lock:
+                self.progress["merged"].append(name)
+                self.save_progress()
+
+        self.pipeline.merge_tables(names, on_merged=merged)
+
+    def run(self):
+        pipeline = self.pipeline
+        pipeline.run_id = f"backfill_{self.backfill_id}"
+        pipeline.warehouse.create_datasets()
+
+        tables = list(TABLES)
+        pipeline.warehouse.prepare_tables(tables)
+        if pipeline.fingerprint_path:
+            pipeline.check_fingerprints(tables)
+        if self.progress["watermarks"] is None:
+            # Probed before anything is extracted, so nothing newer is skipped later.
+            self.progress["watermarks"] = self.get_watermarks(tables)
+            self.save_progress()
+
+        todo = [
+            (table_name, lo, hi)
+            for table_name, lo, hi in self.tasks(tables)
+            if f"{table_name}/{lo}_{hi}" not in self.progress["extracted"]
+        ]
+        total = len(list(self.tasks(tables)))
+        if todo:
+            pipeline.load_active_works()
+            if pipeline.date_source == "calendar":
+                pipeline.calendar_rows = pipeline.get_calendar_rows()
+        print(f"Backfill {self.backfill_id}: {total - len(todo)}/{total} windows done", flush=True)
+
+        started = time.monotonic()
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            futures = {executor.submit(self.extract, *task): task for task in todo}
+            for finished, future in enumerate(as_completed(futures), start=1):
+                table_name, lo, hi = futures[future]
+                seconds = future.result()
+                elapsed = time.monotonic() - started
+                eta = elapsed / finished * (len(todo) - finished)
+                print(
+                    f"[{total - len(todo) + finished}/{total}] {table_name} {lo}..{hi} "
+                    f"in {seconds:.0f}s, ETA {eta / 60:.0f} min",
+                    flush=True,
+                )
+
+        self.merge(tables)
+
+        if pipeline.fingerprint_path:
+            fingerprint_store = FingerprintStore(pipeline.fingerprint_path)
+            for table_name in tables:
+                fingerprint_store.commit(pipeline.run_id, table_name)
+            fingerprint_store.close()
+
+        pipeline.watermarks.save(self.progress["watermarks"])
+        pipeline.set_keys()
+        for table_name, lo, hi in self.tasks(tables):
+            delete_staged_files(self.window_prefix(table_name, lo, hi))
+        print(f"Backfill {self.backfill_id} finished", flush=True)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--start", type=date.fromisoformat, default=date.fromisoformat(DEFAULT_START))
+    parser.add_argument("--end", type=date.fromisoformat, default=date.today())
+    parser.add_argument("--window-months", type=int, default=1)
+    parser.add_argument("--concurrency", type=int, default=2)
+    parser.add_argument("--windows-per-minute", type=float, default=None)
+    args = parser.parse_args()
+
+    Backfill(
+        DataPipeline(),
+        args.start,
+        args.end,
+        window_months=args.window_months,
+        concurrency=args.concurrency,
+        windows_per_minute=args.windows_per_minute,
+    ).run()
+
+
+if __name__ == "__main__":
+    main()
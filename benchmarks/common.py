@@ -0,0 +1,41 @@
+import random
+import resource
+import sys
+from datetime import date, timedelta
+from decimal import Decimal
+
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is kilobytes on Linux and bytes on macOS.
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+# Rows shaped like what ReadFromPostgres yields for return_fact, including
+# the Decimal values pg8000 returns for EXTRACT(...) expressions.
+def return_fact_rows(count, seed=0):
+    rng = random.Random(seed)
+    start = date(2015, 1, 1)
+    for _ in range(count):
+        day = start + timedelta(days=rng.randrange(3650))
+        yield {
+            "pages": rng.randrange(50, 1200),
+            "items_left": rng.randrange(0, 5),
+            "days_loaned": Decimal(rng.randrange(1, 60)),
+            "work_age": Decimal(rng.randrange(0, 200)),
+            "reader_age": rng.randrange(6, 90),
+            "user_id": rng.randrange(1, 100000),
+            "date_id": int(day.strftime("%Y%m%d")),
+            "work_id": rng.randrange(1, 500000),
+            "medium_id": rng.randrange(1, 4),
+            "language_id": rng.choice(["ukr", "eng", "pol", "deu"]),
+        }
+
+
+def report(name, rows, seconds, **extra):
+    fields = " ".join(f"{key}={value}" for key, value in extra.items())
+    print(
+        f"{name}: {rows} rows in {seconds:.2f}s, {rows / seconds:,.0f} rows/s, "
+        f"peak RSS {peak_rss_mb():.0f} MB {fields}".rstrip(),
+        flush=True,
+    )
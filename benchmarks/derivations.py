@@ -0,0 +1,104 @@
+"""Throughput of the vectorized raw-mode derivations.
+
+    python -m benchmarks.derivations --rows 1000000 --fetch-size 10000
+
+Builds fetch_size-row batches of raw return_fact and user columns (what the
+queries.raw_* queries return) and runs derivations.derive on them, next to a
+row-at-a-time Python version of the same expressions whose output it must
+match.
+"""
+import argparse
+import random
+import time
+from datetime import date, datetime, timedelta
+
+from benchmarks.common import report
+from derivations import AGE_GROUPS, GENDERS, derive, raw_record_batch
+
+TODAY = date(2024, 6, 15)
+ENUM_MAPS = {
+    "item_medium_type": {"PAPERBACK": 1, "HARDCOVER": 2, "EBOOK": 3, "AUDIOBOOK": 4},
+    "reading_status_type": {"WANT_TO_READ": 1, "READING": 2, "READ": 3},
+}
+RAW_COLUMNS = {
+    "return_fact": [
+        "pages", "items_left", "loaned_at", "returned_at", "release_year",
+        "birthday", "user_id", "work_id", "medium", "language_id",
+    ],
+    "user": ["user_id", "birthday", "gender", "first_name", "last_name"],
+}
+
+
+def raw_rows(table_name, count, seed=0):
+    rng = random.Random(seed)
+    for i in range(count):
+        birthday = date(1940, 1, 1) + timedelta(days=rng.randrange(30000))
+        if table_name == "user":
+            yield (i, birthday, rng.choice("fmn"), f"User{i}", f"Reader{i}")
+            continue
+        loaned_at = datetime(2015, 1, 1) + timedelta(minutes=rng.randrange(5_000_000))
+        yield (
+            rng.randrange(50, 1200), rng.randrange(0, 5), loaned_at,
+            loaned_at + timedelta(minutes=rng.randrange(60, 60 * 24 * 40)), rng.randrange(1900, 2024),
+            birthday, rng.randrange(1, 100000), rng.randrange(1, 500000),
+            rng.choice(list(ENUM_MAPS["item_medium_type"])), rng.choice(["ukr", "eng", "pol", "deu"]),
+        )
+
+
+def full_years(birthday):
+    return TODAY.year - birthday.year - ((TODAY.month, TODAY.day) < (birthday.month, birthday.day))
+
+
+def derive_row(table_name, row):
+    row = dict(zip(RAW_COLUMNS[table_name], row))
+    if table_name == "user":
+        age = full_years(row["birthday"])
+        return {
+            "user_id": row["user_id"],
+            "age_group": next((label for lo, hi, label in AGE_GROUPS if lo <= age <= hi), "50+"),
+            "gender": GENDERS.get(row["gender"], row["gender"]),
+            "first_name": row["first_name"],
+            "full_name": f"{row['first_name']} {row['last_name']}",
+        }
+    returned_at = row["returned_at"]
+    return {
+        "pages": row["pages"],
+        "items_left": row["items_left"],
+        "work_age": TODAY.year - row["release_year"],
+        "reader_age": full_years(row["birthday"]),
+        "days_loaned": (returned_at - row["loaned_at"]).days,
+        "user_id": row["user_id"],
+        "date_id": returned_at.year * 10000 + returned_at.month * 100 + returned_at.day,
+        "work_id": row["work_id"],
+        "medium_id": ENUM_MAPS["item_medium_type"][row["medium"]],
+        "language_id": row["language_id"],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--fetch-size", type=int, default=10000)
+    args = parser.parse_args()
+
+    for table_name, keys in RAW_COLUMNS.items():
+        rows = list(raw_rows(table_name, args.rows))
+        partitions = [rows[i:i + args.fetch_size] for i in range(0, len(rows), args.fetch_size)]
+
+        started = time.perf_counter()
+        batches = [
+            derive(raw_record_batch(keys, partition), table_name, TODAY, ENUM_MAPS) for partition in partitions
+        ]
+        report(f"{table_name} vectorized", len(rows), time.perf_counter() - started)
+        vectorized = [row for batch in batches for row in batch.to_pylist()]
+
+        started = time.perf_counter()
+        row_wise = [derive_row(table_name, row) for row in rows]
+        report(f"{table_name} row by row", len(rows), time.perf_counter() - started)
+
+        mismatched = sum(a != b for a, b in zip(vectorized, row_wise))
+        print(f"{table_name}: {mismatched} mismatched rows", flush=True)
+
+
+if __name__ == "__main__":
+    main()
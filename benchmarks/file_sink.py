@@ -0,0 +1,54 @@
+"""Offline Parquet encoding throughput of the staging file sink.
+
+    python -m benchmarks.file_sink --rows 1000000 --row-group-size 50000
+"""
+import argparse
+import os
+import tempfile
+import time
+
+from file_sink import WriteParquetFiles, staged_files
+from benchmarks.common import report, return_fact_rows
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--row-group-size", type=int, default=50000)
+    parser.add_argument("--max-file-mb", type=int, default=128)
+    parser.add_argument("--compression", default="snappy")
+    parser.add_argument("--output", default=None, help="local directory, defaults to a temp dir")
+    args = parser.parse_args()
+
+    output = args.output or tempfile.mkdtemp(prefix="etl-sink-")
+    sink = WriteParquetFiles(
+        "return_fact",
+        output,
+        row_group_size=args.row_group_size,
+        max_file_bytes=args.max_file_mb * 1024 * 1024,
+        compression=args.compression,
+    )
+    rows = list(return_fact_rows(args.rows))
+
+    started = time.perf_counter()
+    sink.setup()
+    sink.start_bundle()
+    for row in rows:
+        sink.process(row)
+    list(sink.finish_bundle())
+    elapsed = time.perf_counter() - started
+
+    files = staged_files(output)
+    size = sum(os.path.getsize(path) for path in files)
+    report(
+        "parquet sink",
+        args.rows,
+        elapsed,
+        files=len(files),
+        mb=f"{size / 1024 / 1024:.1f}",
+        output=output,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+"""Dict rows vs Arrow record batches as the in-pipeline row format.
+
+    python -m benchmarks.record_batches --rows 2000000 --fetch-size 10000
+
+Each format runs in its own process so peak RSS is measured separately. Both
+start from fetch_size-row partitions of tuples, like SQLAlchemy hands them to
+ReadFromPostgres, and end with what Beam does to every element between
+stages: pickle it.
+"""
+import argparse
+import pickle
+import subprocess
+import sys
+import time
+
+from arrow_schemas import arrow_schema, record_batch_from_tuples
+from benchmarks.common import report, return_fact_rows
+
+
+def partitions(rows, fetch_size):
+    keys = None
+    partition = []
+    for row in return_fact_rows(rows):
+        keys = keys or list(row)
+        partition.append(tuple(row.values()))
+        if len(partition) == fetch_size:
+            yield keys, partition
+            partition = []
+    if partition:
+        yield keys, partition
+
+
+def run(output_format, rows, fetch_size):
+    schema = arrow_schema("return_fact")
+    encoded_bytes = 0
+    elapsed = 0.0
+    for keys, partition in partitions(rows, fetch_size):
+        started = time.perf_counter()
+        if output_format == "batches":
+            elements = [record_batch_from_tuples(keys, partition, "return_fact", schema)]
+        else:
+            elements = [dict(zip(keys, row)) for row in partition]
+        encoded_bytes += sum(len(pickle.dumps(element)) for element in elements)
+        elapsed += time.perf_counter() - started
+    report(output_format, rows, elapsed, encoded_mb=f"{encoded_bytes / 1024 / 1024:.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--fetch-size", type=int, default=10000)
+    parser.add_argument("--format", choices=["rows", "batches"])
+    args = parser.parse_args()
+
+    if args.format:
+        run(args.format, args.rows, args.fetch_size)
+        return
+    for output_format in ("rows", "batches"):
+        subprocess.run(
+            [
+                sys.executable, "-m", "benchmarks.record_batches",
+                "--rows", str(args.rows),
+                "--fetch-size", str(args.fetch_size),
+                "--format", output_format,
+            ],
+            check=True,
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -97,3 +97,24 @@ schemas: Dict[str, List[bigquery.SchemaField]] = {
         bigquery.SchemaField("publisher_name", "STRING", mode="NULLABLE"),
     ],
 }
+
+
+# date_id is YYYYMMDD, so steps of 100 give one partition per month (the
+# unused YYYY13..YYYY99 ranges stay empty). 2000-2049 keeps the table at
+# 5000 partitions, older days land in __UNPARTITIONED__.
+DATE_ID_PARTITIONING = bigquery.RangePartitioning(
+    field="date_id",
+    range_=bigquery.PartitionRange(start=20000101, end=20500101, interval=100),
+)
+
+partitioning: Dict[str, bigquery.RangePartitioning] = {
+    "return_fact": DATE_ID_PARTITIONING,
+    "rating_fact": DATE_ID_PARTITIONING,
+    "listing_fact": DATE_ID_PARTITIONING,
+}
+
+clustering: Dict[str, List[str]] = {
+    "return_fact": ["work_id", "user_id"],
+    "rating_fact": ["work_id", "user_id"],
+    "listing_fact": ["work_id", "user_id"],
+}
@@ -0,0 +1,53 @@
+from datetime import date, timedelta
+
+# Matches TO_CHAR(date, 'FMMonth') independent of the worker's locale.
+MONTH_NAMES = (
+    "January", "February", "March", "April", "May", "June",
+    "July", "August", "September", "October", "November", "December",
+)
+
+
+def date_id(day):
+    return day.year * 10000 + day.month * 100 + day.day
+
+
+def from_date_id(value):
+    return date(value // 10000, value // 100 % 100, value % 100)
+
+
+# Same columns and formatting as queries.date.
+def calendar_row(day):
+    return {
+        "year": day.year,
+        "month": f"{MONTH_NAMES[day.month - 1]} {day.year}",
+        "quarter": f"Q{(day.month - 1) // 3 + 1} {day.year}",
+        "date": day,
+        "date_id": date_id(day),
+    }
+
+
+def calendar_rows(start: date, end: date, loaded_ids=()):
+    loaded_ids = set(loaded_ids)
+    day = start
+    while day <= end:
+        if date_id(day) not in loaded_ids:
+            yield calendar_row(day)
+        day += timedelta(days=1)
+
+
+# bounds is (lowest date_id, highest date_id, number of date_ids) of the
+# loaded date table. The calendar is loaded in contiguous ranges, so without
+# gaps only the days outside those bounds are missing; a table with gaps
+# (e.g. from date_source="query") has its ids within [start, end] read with
+# loaded_ids(lo_id, hi_id).
+def missing_calendar_rows(start: date, end: date, bounds, loaded_ids):
+    lo, hi, days = bounds
+    if lo is None:
+        return list(calendar_rows(start, end))
+    lo_day, hi_day = from_date_id(lo), from_date_id(hi)
+    if (hi_day - lo_day).days + 1 == days:
+        return [
+            *calendar_rows(start, min(end, lo_day - timedelta(days=1))),
+            *calendar_rows(max(start, hi_day + timedelta(days=1)), end),
+        ]
+    return list(calendar_rows(start, end, loaded_ids(date_id(start), date_id(end))))
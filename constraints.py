@@ -0,0 +1,78 @@
+from bigquery_schemas import schemas
+
+CATALOG_NAME = "constraints.json"
+
+
+# (constraint key, ALTER statement) for every PK and FK described in the schemas.
+def expected_constraints(dataset_id):
+    for table_name, fields in schemas.items():
+        pk_fields = [field.name for field in fields if field.description and "PK" in field.description]
+        if pk_fields:
+            yield (
+                f"PRIMARY KEY:{table_name}",
+                f"ALTER TABLE `{dataset_id}.{table_name}` ADD PRIMARY KEY ({', '.join(pk_fields)}) NOT ENFORCED",
+            )
+        for field in fields:
+            if not (field.description and "FK" in field.description):
+                continue
+            references = field.description.split()[-1]
+            yield (
+                f"FOREIGN KEY:{table_name}:{field.name}",
+                f"ALTER TABLE `{dataset_id}.{table_name}` ADD CONSTRAINT FK_{table_name}_{field.name} "
+                f"FOREIGN KEY ({field.name}) REFERENCES `{dataset_id}.{references}`({field.name}) NOT ENFORCED",
+            )
+
+
+def existing_constraints(client, dataset_id):
+    rows = client.query(
+        f"""
+        SELECT tc.table_name, tc.constraint_type, kcu.column_name
+        FROM `{dataset_id}`.INFORMATION_SCHEMA.TABLE_CONSTRAINTS tc
+        LEFT JOIN `{dataset_id}`.INFORMATION_SCHEMA.KEY_COLUMN_USAGE kcu
+        ON kcu.constraint_name = tc.constraint_name AND kcu.table_name = tc.table_name
+        """
+    ).result()
+    existing = set()
+    for row in rows:
+        if row.constraint_type == "PRIMARY KEY":
+            existing.add(f"PRIMARY KEY:{row.table_name}")
+        elif row.constraint_type == "FOREIGN KEY":
+            existing.add(f"FOREIGN KEY:{row.table_name}:{row.column_name}")
+    return existing
+
+
+# The catalog of constraints known to exist is cached in the state store, so
+# a run where nothing is missing issues no BigQuery queries at all.
+# INFORMATION_SCHEMA is only consulted when the cache says something is
+# missing, and ALTERs only go out for keys that are really absent.
+def ensure_constraints(client, store, dataset_id):
+    expected = dict(expected_constraints(dataset_id))
+    cached = set(store.read(CATALOG_NAME, default=[]))
+    if expected.keys() <= cached:
+        return
+
+    existing = existing_constraints(client, dataset_id)
+    # An FK can be rejected while the PK it references does not exist yet,
+    # so the PKs are added first and the FKs once their jobs are done.
+    for kind in ("PRIMARY KEY", "FOREIGN KEY"):
+        jobs = {
+            key: client.query(statement)
+            for key, statement in expected.items()
+            if key.startswith(f"{kind}:") and key not in existing
+        }
+        for key, job in jobs.items():
+            try:
+                job.result()
+                existing.add(key)
+                print(f"Added {key}", flush=True)
+            except Exception as e:
+                print(f"Could not add {key}: {e}", flush=True)
+    store.write(CATALOG_NAME, sorted(existing))
+
+
+def forget_table(store, table_name):
+    cached = store.read(CATALOG_NAME, default=[])
+    store.write(
+        CATALOG_NAME,
+        [key for key in cached if key.split(":")[1] != table_name],
+    )
@@ -0,0 +1,185 @@
+import time
+from datetime import date
+
+import apache_beam as beam
+import pyarrow as pa
+import pyarrow.compute as pc
+
+from arrow_schemas import ARROW_TYPES, arrow_schema
+from bigquery_schemas import schemas
+from calendar_dimension import MONTH_NAMES
+from run_metrics import counter
+
+# queries.user's CASE over EXTRACT(YEAR FROM AGE(birthday)); anything else,
+# including a NULL or negative age, is '50+'.
+AGE_GROUPS = ((0, 12, "0-12"), (13, 19, "13-19"), (20, 29, "20-29"), (30, 39, "30-39"), (40, 49, "40-49"))
+GENDERS = {"f": "female", "m": "male", "n": "non-binary"}
+
+MICROSECONDS_PER_DAY = 86400 * 10**6
+
+
+def raw_record_batch(keys, rows):
+    columns = list(zip(*rows)) if rows else [() for _ in keys]
+    return pa.RecordBatch.from_arrays([pa.array(list(column)) for column in columns], names=keys)
+
+
+def _column(batch, name, arrow_type):
+    # A fetch where every value is NULL comes out as Arrow's null type.
+    return batch.column(name).cast(arrow_type)
+
+
+# EXTRACT(YEAR FROM AGE(now(), birthday)): completed years on `today`.
+def full_years(birthday, today: date):
+    birthday = birthday.cast(pa.date32())
+    month = pc.month(birthday)
+    not_yet = pc.or_(
+        pc.greater(month, today.month),
+        pc.and_(pc.equal(month, today.month), pc.greater(pc.day(birthday), today.day)),
+    )
+    return pc.subtract(pc.subtract(today.year, pc.year(birthday)), not_yet.cast(pa.int64()))
+
+
+# TO_CHAR(ts, 'YYYYMMDD')::INTEGER
+def date_ids(timestamps):
+    return pc.add(
+        pc.add(pc.multiply(pc.year(timestamps), 10000), pc.multiply(pc.month(timestamps), 100)),
+        pc.day(timestamps),
+    )
+
+
+# EXTRACT('Day' FROM returned_at - loaned_at): the interval's day field,
+# truncated towards zero like Postgres does for negative intervals.
+def days_between(start, end):
+    elapsed = pc.subtract(end, start).cast(pa.int64())
+    return pc.divide(elapsed, MICROSECONDS_PER_DAY)
+
+
+# EXTRACT(YEAR FROM CURRENT_DATE) - release_year
+def work_ages(release_year, today: date):
+    return pc.subtract(today.year, release_year.cast(pa.int64()))
+
+
+def map_values(values, mapping, value_type):
+    labels = pa.array(list(mapping), type=pa.string())
+    return pc.take(pa.array(list(mapping.values()), type=value_type), pc.index_in(values, value_set=labels))
+
+
+def age_groups(ages):
+    groups = pa.array(["50+"] * len(ages), type=pa.string())
+    for lo, hi, label in reversed(AGE_GROUPS):
+        matches = pc.fill_null(pc.and_(pc.greater_equal(ages, lo), pc.less_equal(ages, hi)), False)
+        groups = pc.if_else(matches, label, groups)
+    return groups
+
+
+def _year_strings(days):
+    return pc.year(days).cast(pa.string())
+
+
+def derive_user(batch, today, enum_maps):
+    gender = _column(batch, "gender", pa.string())
+    return {
+        "age_group": age_groups(full_years(_column(batch, "birthday", pa.date32()), today)),
+        "gender": pc.coalesce(map_values(gender, GENDERS, pa.string()), gender),
+        # CONCAT skips NULLs instead of returning NULL.
+        "full_name": pc.binary_join_element_wise(
+            pc.fill_null(_column(batch, "first_name", pa.string()), ""),
+            pc.fill_null(_column(batch, "last_name", pa.string()), ""),
+            " ",
+        ),
+    }
+
+
+def derive_date(batch, today, enum_maps):
+    days = _column(batch, "date", pa.date32())
+    year = _year_strings(days)
+    return {
+        "year": pc.year(days),
+        "month": pc.binary_join_element_wise(
+            pc.take(pa.array(MONTH_NAMES), pc.subtract(pc.month(days), 1)), year, " "
+        ),
+        "quarter": pc.binary_join_element_wise(
+            pc.binary_join_element_wise("Q", pc.quarter(days).cast(pa.string()), ""), year, " "
+        ),
+        "date": days,
+        "date_id": date_ids(days),
+    }
+
+
+def _fact_columns(batch, today, at):
+    return {
+        "work_age": work_ages(_column(batch, "release_year", pa.int64()), today),
+        "reader_age": full_years(_column(batch, "birthday", pa.date32()), today),
+        "date_id": date_ids(_column(batch, at, pa.timestamp("us"))),
+    }
+
+
+def derive_return_fact(batch, today, enum_maps):
+    returned_at = _column(batch, "returned_at", pa.timestamp("us"))
+    return {
+        **_fact_columns(batch, today, "returned_at"),
+        "days_loaned": days_between(_column(batch, "loaned_at", pa.timestamp("us")), returned_at),
+        "medium_id": map_values(
+            _column(batch, "medium", pa.string()), enum_maps["item_medium_type"], pa.int64()
+        ),
+    }
+
+
+def derive_rating_fact(batch, today, enum_maps):
+    return _fact_columns(batch, today, "rated_at")
+
+
+def derive_listing_fact(batch, today, enum_maps):
+    return {
+        **_fact_columns(batch, today, "listed_at"),
+        "listing_type_id": map_values(
+            _column(batch, "reading_status", pa.string()), enum_maps["reading_status_type"], pa.int64()
+        ),
+    }
+
+
+DERIVATIONS = {
+    "user": derive_user,
+    "date": derive_date,
+    "return_fact": derive_return_fact,
+    "rating_fact": derive_rating_fact,
+    "listing_fact": derive_listing_fact,
+}
+
+
+# Turns a batch of raw columns (queries.raw_*) into a batch with the
+# table's schema; columns with no derivation are passed through.
+def derive(batch, table_name, today: date, enum_maps, schema=None):
+    derived = DERIVATIONS[table_name](batch, today, enum_maps)
+    arrays = [
+        (derived[field.name] if field.name in derived else batch.column(field.name)).cast(
+            ARROW_TYPES[field.field_type]
+        )
+        for field in schemas[table_name]
+    ]
+    return pa.RecordBatch.from_arrays(arrays, schema=schema or arrow_schema(table_name))
+
+
+class DeriveColumns(beam.DoFn):
+    def __init__(self, table_name, today: date, enum_maps, output_format="rows"):
+        self.table_name = table_name
+        # Fixed when the pipeline is built, so every shard and worker computes
+        # ages against the same day.
+        self.today = today
+        self.enum_maps = enum_maps
+        self.output_format = output_format
+
+    def setup(self):
+        self.schema = arrow_schema(self.table_name)
+        self.rows = counter(self.table_name, "transform", "rows")
+        self.busy_ms = counter(self.table_name, "transform", "busy_ms")
+
+    def process(self, batch):
+        started = time.perf_counter()
+        derived = derive(batch, self.table_name, self.today, self.enum_maps, self.schema)
+        self.busy_ms.inc(int((time.perf_counter() - started) * 1000))
+        self.rows.inc(derived.num_rows)
+        if self.output_format == "batches":
+            yield derived
+            return
+        yield from derived.to_pylist()
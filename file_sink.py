@@ -0,0 +1,137 @@
+import time
+from uuid import uuid4
+
+import apache_beam as beam
+from apache_beam.io.filesystems import FileSystems
+from apache_beam.transforms.window import GlobalWindows
+import pyarrow as pa
+import pyarrow.parquet as pq
+from google.cloud import bigquery
+
+from arrow_schemas import arrow_schema, to_record_batch
+from bigquery_schemas import schemas
+from run_metrics import counter
+
+
+# Encodes rows into Parquet files under path_prefix and outputs their paths.
+# path_prefix may be gs:// or a local directory (what the encoding benchmark
+# uses). A file is closed once it reaches max_file_bytes and every row group
+# holds row_group_size rows.
+class WriteParquetFiles(beam.DoFn):
+    def __init__(
+        self,
+        table_name: str,
+        path_prefix: str,
+        row_group_size=50000,
+        max_file_bytes=128 * 1024 * 1024,
+        compression="snappy",
+    ):
+        self.table_name = table_name
+        self.path_prefix = path_prefix.rstrip("/")
+        self.row_group_size = row_group_size
+        self.max_file_bytes = max_file_bytes
+        self.compression = compression
+
+    def setup(self):
+        self.schema = arrow_schema(self.table_name)
+        self.rows = counter(self.table_name, "stage_load", "rows")
+        self.bytes = counter(self.table_name, "stage_load", "bytes")
+        self.files = counter(self.table_name, "stage_load", "files")
+        self.write_ms = counter(self.table_name, "stage_load", "write_ms")
+
+    def start_bundle(self):
+        self._rows = []
+        self._batches = []
+        self._pending = 0
+        self._buffer = None
+        self._writer = None
+        self._written = []
+
+    def process(self, element):
+        # Record batches from ReadFromPostgres(output_format="batches") and
+        # dict rows are both collected until they fill a row group, however
+        # small the fetches are.
+        if isinstance(element, pa.RecordBatch):
+            self._batches.append(element)
+            self._pending += element.num_rows
+        else:
+            self._rows.append(element)
+            self._pending += 1
+        if self._pending >= self.row_group_size:
+            self._write_row_groups()
+
+    def finish_bundle(self):
+        self._write_row_groups(final=True)
+        self._close_file()
+        for path in self._written:
+            yield GlobalWindows.windowed_value(path)
+
+    def _write_row_groups(self, final=False):
+        # Writes the full row groups collected so far, or everything at the
+        # end of the bundle; the rest waits for more rows.
+        if self._rows:
+            rows, self._rows = self._rows, []
+            self._batches.append(to_record_batch(rows, self.table_name, self.schema))
+        if not self._batches:
+            return
+        table = pa.Table.from_batches(self._batches, schema=self.schema)
+        full = table.num_rows if final else table.num_rows - table.num_rows % self.row_group_size
+        self._write_table(table.slice(0, full))
+        rest = table.slice(full)
+        self._batches = rest.to_batches()
+        self._pending = rest.num_rows
+
+    def _write_table(self, table):
+        if table.num_rows == 0:
+            return
+        started = time.perf_counter()
+        self.rows.inc(table.num_rows)
+        if self._writer is None:
+            self._buffer = pa.BufferOutputStream()
+            self._writer = pq.ParquetWriter(
+                self._buffer, self.schema, compression=self.compression
+            )
+        self._writer.write_table(table, row_group_size=self.row_group_size)
+        self.write_ms.inc(int((time.perf_counter() - started) * 1000))
+        if self._buffer.tell() >= self.max_file_bytes:
+            self._close_file()
+
+    def _close_file(self):
+        if self._writer is None:
+            return
+        started = time.perf_counter()
+        self._writer.close()
+        path = f"{self.path_prefix}/{self.table_name}-{uuid4().hex}.parquet"
+        data = self._buffer.getvalue().to_pybytes()
+        with FileSystems.create(path) as f:
+            f.write(data)
+        self.bytes.inc(len(data))
+        self.files.inc()
+        self.write_ms.inc(int((time.perf_counter() - started) * 1000))
+        self._written.append(path)
+        self._writer = None
+        self._buffer = None
+
+
+def staged_files(path_prefix):
+    match = FileSystems.match([f"{path_prefix.rstrip('/')}/*.parquet"])[0]
+    return [metadata.path for metadata in match.metadata_list]
+
+
+def load_files(client: bigquery.Client, table_id: str, table_name: str, files):
+    if not files:
+        return None
+    job_config = bigquery.LoadJobConfig(
+        source_format=bigquery.SourceFormat.PARQUET,
+        # Truncating makes a repeated load of the same files (a resumed run)
+        # replace the staged rows instead of duplicating them.
+        write_disposition=bigquery.WriteDisposition.WRITE_TRUNCATE,
+        schema=schemas[table_name],
+    )
+    return client.load_table_from_uri(files, table_id, job_config=job_config)
+
+
+def delete_staged_files(path_prefix):
+    files = staged_files(path_prefix)
+    if files:
+        FileSystems.delete(files)
@@ -0,0 +1,159 @@
+import hashlib
+import json
+import sqlite3
+
+import apache_beam as beam
+import pyarrow as pa
+from apache_beam.transforms.window import GlobalWindows
+
+from bigquery_schemas import schemas
+from run_metrics import counter
+
+# Dimensions whose rows are re-sent whenever modified_at moves, even if no
+# exported column changed.
+DIMENSIONS = ("work", "user", "author", "publisher", "subject", "language")
+
+
+def primary_key(table_name):
+    return [field.name for field in schemas[table_name] if field.description and "PK" in field.description]
+
+
+def row_key(row, key_fields):
+    return json.dumps([row.get(name) for name in key_fields], default=str)
+
+
+def row_fingerprint(row, table_name):
+    values = json.dumps([row.get(field.name) for field in schemas[table_name]], default=str)
+    return hashlib.blake2b(values.encode(), digest_size=16).hexdigest()
+
+
+# Fingerprints of the rows already merged into the warehouse, kept in a local
+# SQLite file. New fingerprints are staged per run and only promoted once the
+# run's MERGE succeeded, so a failed run never hides rows from the next one.
+class FingerprintStore:
+    def __init__(self, path, cache_kb=16 * 1024):
+        self.path = path
+        self.conn = sqlite3.connect(path, timeout=600, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(f"PRAGMA cache_size=-{cache_kb}")
+        with self.conn:
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS fingerprint ("
+                "table_name TEXT, row_key TEXT, hash TEXT, PRIMARY KEY (table_name, row_key))"
+            )
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS pending_fingerprint ("
+                "run_id TEXT, table_name TEXT, row_key TEXT, hash TEXT, "
+                "PRIMARY KEY (run_id, table_name, row_key))"
+            )
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS fingerprint_target (table_name TEXT PRIMARY KEY, identity TEXT)"
+            )
+
+    def check_target(self, table_name, identity):
+        # identity changes whenever the target table is recreated (its
+        # creation time or a UUID), and the rows the fingerprints stand for are
+        # gone with the old table, so they have to be sent again.
+        known = self.conn.execute(
+            "SELECT identity FROM fingerprint_target WHERE table_name = ?", (table_name,)
+        ).fetchone()
+        if known is not None and known[0] == identity:
+            return
+        with self.conn:
+            deleted = self.conn.execute("DELETE FROM fingerprint WHERE table_name = ?", (table_name,)).rowcount
+            self.conn.execute("DELETE FROM pending_fingerprint WHERE table_name = ?", (table_name,))
+            self.conn.execute("INSERT OR REPLACE INTO fingerprint_target VALUES (?, ?)", (table_name, identity))
+        if deleted:
+            print(f"{table_name} was recreated, forgot {deleted} fingerprints", flush=True)
+
+    def lookup(self, table_name, keys, chunk_size=500):
+        found = {}
+        for i in range(0, len(keys), chunk_size):
+            chunk = keys[i:i + chunk_size]
+            placeholders = ", ".join("?" * len(chunk))
+            found.update(
+                self.conn.execute(
+                    f"SELECT row_key, hash FROM fingerprint WHERE table_name = ? AND row_key IN ({placeholders})",
+                    [table_name, *chunk],
+                )
+            )
+        return found
+
+    def stage(self, run_id, table_name, items):
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO pending_fingerprint VALUES (?, ?, ?, ?)",
+                [(run_id, table_name, key, fingerprint) for key, fingerprint in items],
+            )
+
+    def commit(self, run_id, table_name):
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO fingerprint "
+                "SELECT table_name, row_key, hash FROM pending_fingerprint WHERE run_id = ? AND table_name = ?",
+                (run_id, table_name),
+            )
+            self.conn.execute(
+                "DELETE FROM pending_fingerprint WHERE run_id = ? AND table_name = ?",
+                (run_id, table_name),
+            )
+
+    def discard_pending(self, keep_run_id=None):
+        with self.conn:
+            self.conn.execute("DELETE FROM pending_fingerprint WHERE run_id IS NOT ?", (keep_run_id,))
+
+    def close(self):
+        self.conn.close()
+
+
+class DropUnchangedRows(beam.DoFn):
+    def __init__(self, table_name: str, store_path: str, run_id: str, batch_size=1000):
+        self.table_name = table_name
+        self.store_path = store_path
+        self.run_id = run_id
+        # Rows are checked against the store batch_size at a time, which also
+        # bounds how many rows the DoFn holds.
+        self.batch_size = batch_size
+
+    def setup(self):
+        self.store = FingerprintStore(self.store_path)
+        self.key_fields = primary_key(self.table_name)
+        self.unchanged_rows = counter(self.table_name, "transform", "unchanged_rows")
+
+    def teardown(self):
+        self.store.close()
+
+    def start_bundle(self):
+        self._rows = []
+
+    def process(self, row):
+        if isinstance(row, pa.RecordBatch):
+            rows = row.to_pylist()
+            changed = {id(changed_row) for changed_row in self._changed(rows)}
+            if changed:
+                yield row.filter(pa.array([id(r) in changed for r in rows]))
+            return
+        self._rows.append(row)
+        if len(self._rows) >= self.batch_size:
+            yield from self._flush()
+
+    def finish_bundle(self):
+        for row in self._flush():
+            yield GlobalWindows.windowed_value(row)
+
+    def _flush(self):
+        rows, self._rows = self._rows, []
+        if not rows:
+            return []
+        return self._changed(rows)
+
+    def _changed(self, rows):
+        keyed = [
+            (row_key(row, self.key_fields), row_fingerprint(row, self.table_name), row)
+            for row in rows
+        ]
+        known = self.store.lookup(self.table_name, [key for key, _, _ in keyed])
+        changed = [(key, fingerprint, row) for key, fingerprint, row in keyed if known.get(key) != fingerprint]
+        self.store.stage(self.run_id, self.table_name, [(key, fingerprint) for key, fingerprint, _ in changed])
+        self.unchanged_rows.inc(len(rows) - len(changed))
+        return [row for _, _, row in changed]
@@ -1,10 +1,26 @@
 from time import sleep
-from uuid import uuid4
-from bigquery_schemas import schemas
+import time
 import db_secrets as secrets
 import queries
-from datetime import datetime
-from itertools import groupby
+from connections import CloudSqlConnectionFactory, acquire_engine, release_engine
+import sharding
+from arrow_schemas import record_batch_from_tuples
+from file_sink import WriteParquetFiles, delete_staged_files, staged_files
+from state_store import GcsJsonStore
+from watermarks import DEFAULT_START, WATERMARK_COLUMNS, WatermarkStore, probe_earliest, probe_watermark
+from calendar_dimension import missing_calendar_rows
+from fingerprints import DIMENSIONS, DropUnchangedRows, FingerprintStore
+from merge_scheduler import MergeScheduler
+from run_ledger import RunLedger
+from async_extract import ReadFromPostgresAsync
+from derivations import DERIVATIONS, DeriveColumns, raw_record_batch
+from table_registry import TABLES, to_timestamp
+from run_metrics import RunMetrics, counter
+from warehouse import BigQueryWarehouse
+from rollups import ROLLUPS
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import date, datetime
 import logging
 
 import os
@@ -13,213 +29,654 @@ from apache_beam.options.pipeline_options import PipelineOptions
 from apache_beam.io.gcp.bigquery import WriteToBigQuery
 from apache_beam.io import BigQueryDisposition
 import apache_beam as beam
+import pyarrow as pa
 
 from sqlalchemy import text
-import sqlalchemy
 
-from google.cloud.sql.connector import Connector
 from google.cloud.exceptions import NotFound
 from google.oauth2 import service_account
 from google.cloud import bigquery, storage
 
 
 class ReadFromPostgres(beam.DoFn):
-    def __init__(self, credentials):
+    def __init__(
+        self,
+        connection_factory,
+        fetch_size=10000,
+        stream_results=True,
+        pool_size=4,
+        output_format="rows",
+        raw_tables=(),
+    ):
         self.__processed = []
-        self.credentials = credentials
-        self.secrets = secrets
+        self.connection_factory = connection_factory
+        # Rows are pulled through a server-side cursor fetch_size at a time,
+        # so memory stays bounded by the batch instead of the whole table.
+        self.fetch_size = fetch_size
+        self.stream_results = stream_results
+        self.pool_size = pool_size
+        # "rows" yields one dict per row, "batches" one Arrow RecordBatch per
+        # fetch, typed from bigquery_schemas.
+        self.output_format = output_format
+        # Tables read with a queries.raw_* query come out as batches of the
+        # raw columns for DeriveColumns, whatever output_format is.
+        self.raw_tables = raw_tables
+        self.pool = None
+
+    def setup(self):
+        self.pool = acquire_engine(self.connection_factory, pool_size=self.pool_size)
+
+    def teardown(self):
+        if self.pool is not None:
+            release_engine(self.connection_factory, pool_size=self.pool_size)
+            self.pool = None
 
     def process(self, element, table_name: str):
         if element in self.__processed:
             return
         self.__processed.append(element)
-        INSTANCE_CONNECTION_NAME = (
-            f"{self.secrets.PROJECT_ID}:{self.secrets.REGION}:{self.secrets.INSTANCE_ID}"
-        )
-        sql_connector = Connector(credentials=self.credentials)
-        conn = sql_connector.connect(
-            INSTANCE_CONNECTION_NAME,
-            "pg8000",
-            user=secrets.DB_USER,
-            password=secrets.DB_PASS,
-            db=secrets.DB_NAME,
-        )
-
-        pool = sqlalchemy.create_engine(
-            "postgresql+pg8000://", creator=lambda: conn, pool_timeout=36000
-        )
         print(f'Procesing data from {table_name}', flush=True)
-        with pool.connect() as db_conn:
+        with self.pool.connect() as db_conn:
+            if self.stream_results:
+                db_conn = db_conn.execution_options(
+                    stream_results=True, max_row_buffer=self.fetch_size
+                )
             with db_conn.begin():
+                # A cursor is planned for its first 10% of rows by default,
+                # which picks slow fast-start plans; every row is read here.
+                # Not streamed itself: a SET cannot be DECLAREd as a cursor.
+                db_conn.execute(
+                    text("SET LOCAL cursor_tuple_fraction = 1.0"), execution_options={"stream_results": False}
+                )
                 # print(element, flush=True)  # Print the query
-                result = db_conn.execute(text(element))
-                rows = [row._asdict() for row in result]
-        return rows
+                sql, params = element
+                rows = counter(table_name, "extract", "rows")
+                fetch_ms = counter(table_name, "extract", "fetch_ms")
+                started = time.perf_counter()
+                result = db_conn.execute(text(sql), params)
+                keys = list(result.keys())
+                for partition in result.partitions(self.fetch_size):
+                    # Only the time spent waiting on Postgres, not downstream.
+                    fetch_ms.inc(int((time.perf_counter() - started) * 1000))
+                    rows.inc(len(partition))
+                    yield from self.to_elements(keys, partition, table_name)
+                    started = time.perf_counter()
+                fetch_ms.inc(int((time.perf_counter() - started) * 1000))
+
+    def to_elements(self, keys, partition, table_name):
+        if table_name in self.raw_tables:
+            return [raw_record_batch(keys, partition)]
+        if self.output_format == "batches":
+            return [record_batch_from_tuples(keys, partition, table_name)]
+        return [row._asdict() for row in partition]
+
+
+def to_rows(element):
+    # Streaming inserts need one dict per row; everything else takes batches.
+    return element.to_pylist() if isinstance(element, pa.RecordBatch) else [element]
 
 
 class DataPipeline:
-    def __init__(self):
-        self.pipeline_options = PipelineOptions(
-            [
-                f"--project={secrets.PROJECT_ID}",
-                "--runner=DirectRunner",
-                f"--temp_location=gs://{secrets.BUCKET_NAME}/temp",
-                f"--region={secrets.REGION}",
-                "--setup_file=./setup.py"
+    def __init__(
+        self,
+        fetch_size=10000,
+        connection_factory=None,
+        pool_size=4,
+        shards=None,
+        shard_strategy="minmax",
+        sink="file_loads",
+        staging_path=f"gs://{secrets.BUCKET_NAME}/staging",
+        row_group_size=50000,
+        max_file_bytes=128 * 1024 * 1024,
+        state_store=None,
+        return_fact_mode="correlated",
+        date_source="calendar",
+        calendar_start=None,
+        fingerprint_path=None,
+        merge_concurrency=4,
+        merge_retries=2,
+        output_format="rows",
+        runner="DirectRunner",
+        direct_running_mode="in_memory",
+        direct_num_workers=1,
+        pipeline_per_table=False,
+        max_concurrent_pipelines=4,
+        extractor="sync",
+        async_concurrency=8,
+        query_mode="derived",
+        offline=False,
+        warehouse=None,
+        table_order="longest_first",
+        rollups=tuple(ROLLUPS),
+    ):
+        options = [
+            f"--project={secrets.PROJECT_ID}",
+            f"--runner={runner}",
+            f"--temp_location=gs://{secrets.BUCKET_NAME}/temp",
+            f"--region={secrets.REGION}",
+            "--setup_file=./setup.py"
+        ]
+        if runner == "DirectRunner":
+            # "multi_processing" with direct_num_workers > 1 runs bundles in
+            # separate worker processes instead of the driver process.
+            options += [
+                f"--direct_running_mode={direct_running_mode}",
+                f"--direct_num_workers={direct_num_workers}",
             ]
-        )
-        CREDENTIALS = r"M:\Personal\SE\Term 6\Data Warehouses\data population\scripts\cloudsql\credentials.json"
-        os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = CREDENTIALS
-        
-        self.credentials = service_account.Credentials.from_service_account_file(CREDENTIALS)
-        # self.credentials = default()
-        
-        self.bigquery_client = bigquery.Client(credentials=self.credentials, project=self.credentials.project_id)
-        self.storage_client = storage.Client(credentials=self.credentials, project=self.credentials.project_id)
-        
-        self.bucket = self.storage_client.bucket(secrets.BUCKET_NAME)
+        self.pipeline_options = PipelineOptions(options)
+        # offline=True builds no Google Cloud clients, for the benchmarks:
+        # pass a connection_factory and a state_store, and use
+        # extract_to_staging with a local staging_path (and a
+        # DuckDbWarehouse to load and merge into).
+        self.offline = offline
+        if offline:
+            self.credentials = None
+            self.bigquery_client = None
+            self.storage_client = None
+            self.bucket = None
+        else:
+            CREDENTIALS = r"M:\Personal\SE\Term 6\Data Warehouses\data population\scripts\cloudsql\credentials.json"
+            os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = CREDENTIALS
+            
+            self.credentials = service_account.Credentials.from_service_account_file(CREDENTIALS)
+            # self.credentials = default()
+            
+            self.bigquery_client = bigquery.Client(credentials=self.credentials, project=self.credentials.project_id)
+            self.storage_client = storage.Client(credentials=self.credentials, project=self.credentials.project_id)
+            
+            self.bucket = self.storage_client.bucket(secrets.BUCKET_NAME)
         
         self.p = beam.Pipeline(options=self.pipeline_options)
-        self.read_from_postgres = ReadFromPostgres(self.credentials)
-
-
-
-    def generate_merge_sql(self, table_name, schema):
-        try:
-            print(f"Merging {table_name}s...", flush=True)
-            # Generate the SET clause for the UPDATE statement
-            set_clause = ", ".join(
-                [f"TARGET.{field.name} = SOURCE.{field.name}" for field in schema]
-            )
-
-            # Generate the fields and values for the INSERT statement
-            insert_fields = ", ".join([field.name for field in schema])
-            insert_values = ", ".join([f"SOURCE.{field.name}" for field in schema])
-
-            pk_fields = [field for field in schema if field.description and "PK" in field.description]
-            on_clause = " AND ".join(
-                [f"TARGET.{field.name} = SOURCE.{field.name}" for field in pk_fields]
-            )
-
-            merge_sql = f"""
-            MERGE `{secrets.PROJECT_ID}.{secrets.INSTANCE_ID}.{table_name}` AS TARGET
-            USING `{secrets.PROJECT_ID}.{secrets.INSTANCE_ID}_staging.{table_name}` AS SOURCE
-            ON {on_clause}
-            WHEN MATCHED THEN
-                UPDATE SET {set_clause}
-            WHEN NOT MATCHED THEN
-                INSERT ({insert_fields}) 
-                VALUES ({insert_values})
-            """
-            # print(merge_sql, flush=True)
-            return self.bigquery_client.query(merge_sql)
-        except Exception as e:
-            print(table_name, e, flush=True)
-
-
-
-    def get_query(self, start_date, key="", get_all=False):
+        # Any object with key/create_engine/close works here, e.g. a
+        # DsnConnectionFactory pointing at a local PostgreSQL.
+        self.connection_factory = connection_factory or CloudSqlConnectionFactory(self.credentials)
+        self.pool_size = pool_size
+        self.output_format = output_format
+        # "raw" reads user, date and the facts with queries.raw_* and computes
+        # ages, date ids, enum ids, ... in the pipeline (derivations.py)
+        # instead of on the source database.
+        self.query_mode = query_mode
+        self.raw_tables = tuple(DERIVATIONS) if query_mode == "raw" else ()
+        self.enum_maps = None
+        # With pipeline_per_table every table runs as its own Beam pipeline,
+        # at most max_concurrent_pipelines at a time, and is merged as soon as
+        # it is loaded (and the dimensions it references are merged).
+        self.pipeline_per_table = pipeline_per_table
+        self.max_concurrent_pipelines = max_concurrent_pipelines
+        # With pipeline_per_table, "longest_first" starts the tables whose
+        # pipelines took longest in the last run first (per the run reports'
+        # table_history.json), so the small dimensions fill in around the
+        # big facts instead of return_fact starting last; "registry" keeps
+        # the table_registry order. A shared pipeline runs every table at
+        # once, so the order makes no difference there.
+        self.table_order = table_order
+        # Aggregate tables (rollups.py) updated from the facts staged in each
+        # run; () maintains none.
+        self.rollups = rollups
+        self.read_from_postgres = ReadFromPostgres(
+            self.connection_factory,
+            fetch_size=fetch_size,
+            pool_size=pool_size,
+            output_format=output_format,
+            raw_tables=self.raw_tables,
+        )
+        # "async" reads every table and shard of a run from one asyncpg event
+        # loop, async_concurrency queries at a time, instead of one blocking
+        # pg8000 query per ReadFromPostgres call.
+        self.extractor = extractor
+        self.read_from_postgres_async = ReadFromPostgresAsync(
+            self.connection_factory,
+            max_concurrency=async_concurrency,
+            fetch_size=fetch_size,
+            output_format=output_format,
+            raw_tables=self.raw_tables,
+        )
+        # Number of key ranges per table, e.g. {"return_fact": 8}; unlisted tables run as one query.
+        self.shards = shards or {}
+        self.shard_strategy = shard_strategy
+        # "file_loads" stages Parquet files and loads them with one job per
+        # table; "streaming_inserts" is the old row-by-row path.
+        self.sink = sink
+        self.staging_path = staging_path.rstrip("/")
+        self.row_group_size = row_group_size
+        self.max_file_bytes = max_file_bytes
+        self.run_id = None
+        # Where per-run state (watermarks, ...) is kept; a LocalJsonStore
+        # works for local runs.
+        self.state_store = state_store or GcsJsonStore(self.bucket)
+        self.watermarks = WatermarkStore(self.state_store)
+        self.ledger = RunLedger(self.state_store)
+        # Where staged files are loaded and merged: BigQuery, or e.g. a local
+        # warehouse.DuckDbWarehouse.
+        self.warehouse = warehouse or (None if offline else BigQueryWarehouse(self.bigquery_client, self.state_store))
+        # Per-table, per-stage timings and volumes, written to
+        # run_reports/<run_id>.json in the state store at the end of a run.
+        self.metrics = RunMetrics(self.state_store)
+        # "sweep" computes return_fact.items_left with a running sum per work
+        # (queries.return_fact_sweep) instead of the correlated subquery.
+        self.return_fact_mode = return_fact_mode
+        self.active_work_ids = []
+        # "calendar" generates the date dimension locally for every day from
+        # calendar_start (by default the first loan, rating or listing) to
+        # today that is not loaded yet; "query" runs queries.date.
+        self.date_source = date_source
+        self.calendar_start = date.fromisoformat(calendar_start) if calendar_start else None
+        self.calendar_rows = []
+        # Local SQLite file of row hashes; when set, dimension rows whose
+        # exported columns did not change since the last merge are dropped
+        # before staging.
+        self.fingerprint_path = fingerprint_path
+        self.merge_concurrency = merge_concurrency
+        self.merge_retries = merge_retries
+
+
+
+    def rollups_for(self, tables):
+        return [name for name in self.rollups if ROLLUPS[name].fact in tables]
+
+    def merge_tables(self, tables, ready=None, on_merged=None):
+        # Dimensions are merged before the facts referencing them, at most
+        # merge_concurrency at a time, each retried before the run gives up.
+        # A rollup in tables is refreshed from its fact's staged rows once
+        # they are loaded and the dimensions it groups by are merged.
+        ready = dict(ready or {})
+        dependencies = {}
+        for name in tables:
+            if name in ROLLUPS:
+                dependencies[name] = ROLLUPS[name].dimensions()
+                if ROLLUPS[name].fact in ready:
+                    ready[name] = ready[ROLLUPS[name].fact]
+        scheduler = MergeScheduler(
+            self.merge,
+            max_concurrency=self.merge_concurrency,
+            retries=self.merge_retries,
+            on_merged=on_merged or self.record_merge,
+            dependencies=dependencies,
+        )
+        return scheduler.run(tables, ready)
+
+    def merge(self, name):
+        if name in ROLLUPS:
+            return self.warehouse.refresh_rollup(ROLLUPS[name])
+        return self.warehouse.merge(name)
+
+    def record_merge(self, table_name, job):
+        self.metrics.record_merge_job(table_name, job)
+        self.ledger.mark(table_name, "merged")
+
+    def get_query(self, start_date, key="", get_all=False, end_date="infinity"):
+        # (sql, bind parameters) per table. The SQL text is the same for every
+        # run and shard, so each pooled connection prepares it once.
+        values = {
+            "start_date": to_timestamp(start_date),
+            "end_date": to_timestamp(end_date),
+            "active_work_ids": self.active_work_ids,
+        }
         qs = {
-            "work": queries.work.format(start_date=start_date),
-            "user": queries.user.format(start_date=start_date),
-            "publisher": queries.publisher.format(start_date=start_date),
-            "author": queries.author.format(start_date=start_date),
-            "work_author": queries.work_author.format(start_date=start_date),
-            "subject": queries.subject.format(start_date=start_date),
-            "language": queries.language.format(start_date=start_date),
-            "date": queries.date.format(start_date=start_date),
-            "medium": queries.medium,
-            "listing_type": queries.listing_type,
-            "rating_fact": queries.rating_fact.format(start_date=start_date),
-            "listing_fact": queries.listing_fact.format(start_date=start_date),
-            "return_fact": queries.return_fact.format(start_date=start_date),
+            table_name: (spec.sql(self.return_fact_mode, raw=table_name in self.raw_tables), spec.bind(values))
+            for table_name, spec in TABLES.items()
         }
         return qs if get_all else qs.get(key, None)
 
-    def get_or_create_table(self, table_name, staging = False):
-        table_id = f"{secrets.PROJECT_ID}.{secrets.INSTANCE_ID}{'_staging' if staging else ''}.{table_name}"
+    @contextmanager
+    def source_connection(self):
+        # The same engine ReadFromPostgres uses, so probes and extraction
+        # share one pool.
+        engine = acquire_engine(self.connection_factory, pool_size=self.pool_size)
         try:
-            table = self.bigquery_client.get_table(table_id)
-        except NotFound:
-            table = bigquery.Table(table_id, schema=schemas[table_name])
-            table = self.bigquery_client.create_table(table)
-        return table_id
+            with engine.connect() as conn:
+                yield conn
+        finally:
+            release_engine(self.connection_factory, pool_size=self.pool_size)
+
+    def get_start_dates(self, tables):
+        fallback = DEFAULT_START
+        if self.bucket is not None:
+            try:
+                blob = storage.Blob("last_run.txt", self.bucket)
+                fallback = blob.download_as_text().strip()
+            except (NotFound, ValueError):
+                pass
+
+        watermarks = self.watermarks.load()
+        start_dates, new_watermarks = {}, {}
+        with self.source_connection() as conn:
+            for table_name in tables:
+                start_date = watermarks.get(table_name, fallback)
+                if table_name == "date" and self.date_source == "calendar":
+                    self.calendar_rows = self.get_calendar_rows()
+                    if not self.calendar_rows:
+                        print("Skipping date, calendar is up to date", flush=True)
+                        continue
+                elif table_name in WATERMARK_COLUMNS:
+                    watermark = probe_watermark(conn, table_name, start_date)
+                    if watermark is None:
+                        print(f"Skipping {table_name}, no rows after {start_date}", flush=True)
+                        continue
+                    new_watermarks[table_name] = watermark
+                start_dates[table_name] = start_date
+        return start_dates, new_watermarks
+
+    def get_calendar_rows(self):
+        start = self.calendar_start
+        if start is None:
+            with self.source_connection() as conn:
+                earliest = probe_earliest(conn, "date")
+            if earliest is None:
+                return []
+            start = earliest.date() if isinstance(earliest, datetime) else earliest
+        return missing_calendar_rows(
+            start, date.today(), self.warehouse.date_id_bounds(), self.warehouse.loaded_date_ids
+        )
+
+    def load_active_works(self):
+        # One pass over loan/rating/listing per run instead of the EXISTS
+        # probes each of work, publisher, author and work_author used to repeat.
+        with self.source_connection() as conn:
+            self.active_work_ids = sorted(conn.execute(text(queries.active_works)).scalars())
+        print(f"Found {len(self.active_work_ids)} active works", flush=True)
+
+    def get_enum_maps(self):
+        # Read once per run: {"item_medium_type": {"EBOOK": 3, ...}, ...}
+        if self.enum_maps is None:
+            self.enum_maps = {}
+            with self.source_connection() as conn:
+                for type_name, label, sort_order in conn.execute(text(queries.enum_labels)):
+                    self.enum_maps.setdefault(type_name, {})[label] = int(sort_order)
+        return self.enum_maps
+
+    def get_shard_queries(self, table_name, start_date, end_date="infinity"):
+        query = self.get_query(start_date=start_date, key=table_name, end_date=end_date)
+        shards = self.shards.get(table_name, 1)
+        key = sharding.shard_key(table_name)
+        if shards <= 1 or key is None:
+            return [query]
+
+        with self.source_connection() as conn:
+            boundaries = sharding.get_boundaries(
+                conn, table_name, key, shards, self.shard_strategy
+            )
+        print(f"Splitting {table_name} into {len(boundaries) + 1} ranges on {key}", flush=True)
+        return sharding.shard_queries(query, key, boundaries)
 
     def set_keys(self):
-        for key, value in schemas.items():
-            table_name = key
-            fk_fields = ([(field.name, field.description.split()[-1]) for field in value if field.description and "FK" in field.description])
-            [self.bigquery_client.query(f"ALTER TABLE library.{table_name} ADD constraint FK_{table_name}_{str(uuid4())} foreign key ({column_name}) references library.{references}({column_name}) not enforced") for column_name, references in fk_fields] 
-            pk_fields = [(table_name, field.name) for field in value if field.description and "PK" in field.description]
-            pk_fields.sort(key=lambda x: x[0])
-            pk_fields_joined = {table: ', '.join(field for _, field in group) for table, group in groupby(pk_fields, key=lambda x: x[0])}
-            [self.bigquery_client.query(f"ALTER TABLE library.{table_name} ADD primary key ({field}) not enforced") for field in pk_fields_joined.values()]
+        self.warehouse.set_keys()
             
 
-    def create_pipeline(self, table_name: str, start_date: str):
+    def create_pipeline(
+        self,
+        table_name: str,
+        start_date: str,
+        pipeline=None,
+        end_date="infinity",
+        staging_prefix=None,
+    ):
         print(f"Creating tables for {table_name}", flush=True)
         
-        self.get_or_create_table(table_name)
-        table_id = self.get_or_create_table(table_name, staging=True)
+        self.warehouse.get_or_create_table(table_name)
+        table_id = self.warehouse.get_or_create_table(table_name, staging=True)
+        self.extract_to_staging(table_name, start_date, pipeline, end_date, staging_prefix, table_id)
+
+    def extract_to_staging(
+        self,
+        table_name: str,
+        start_date: str,
+        pipeline=None,
+        end_date="infinity",
+        staging_prefix=None,
+        table_id=None,
+    ):
+        # The extract and transform half of create_pipeline; table_id is only
+        # needed for streaming inserts.
+        p = pipeline or self.p
+        if table_name == "date" and self.date_source == "calendar":
+            rows = p | "Generating date calendar" >> beam.Create(self.calendar_rows)
+            self.write_staging(rows, table_name, table_id, staging_prefix)
+            return
 
-        (
-            self.p
+        shard_queries = self.get_shard_queries(table_name, start_date, end_date)
+        if self.extractor == "async":
+            rows = (
+                p
+                | f"Creating queries for {table_name}" >> beam.Create([[(table_name, query) for query in shard_queries]])
+                | f"Reading {table_name} from Cloud SQL"
+                >> beam.ParDo(self.read_from_postgres_async).with_outputs(table_name)
+            )[table_name]
+            self.stage_rows(rows, table_name, table_id, staging_prefix)
+            return
+
+        queries_pcoll = (
+            p
             | f"Creating query for {table_name}" 
-            >> beam.Create([self.get_query(start_date=start_date, key=table_name)])
+            >> beam.Create(shard_queries)
+        )
+        if len(shard_queries) > 1:
+            queries_pcoll = queries_pcoll | f"Distributing {table_name} shards" >> beam.Reshuffle()
+
+        rows = (
+            queries_pcoll
             | f"Reading {table_name} from Cloud SQL"
             >> beam.ParDo(self.read_from_postgres, table_name)
-            | f"Writing {table_name} to the temporary BigQuery table"
-            >> WriteToBigQuery(
+        )
+        self.stage_rows(rows, table_name, table_id, staging_prefix)
+
+    def create_async_pipeline(self, tables, start_dates, pipeline=None):
+        # One ParDo issues the queries of all tables, so they overlap on the
+        # network instead of running in whatever order Beam schedules them.
+        p = pipeline or self.p
+        jobs = []
+        for table_name in tables:
+            if table_name == "date" and self.date_source == "calendar":
+                self.create_pipeline(table_name, start_dates[table_name], p)
+                continue
+            jobs += [
+                (table_name, query)
+                for query in self.get_shard_queries(table_name, start_dates[table_name])
+            ]
+        if not jobs:
+            return
+
+        extracted = list(dict.fromkeys(table_name for table_name, _ in jobs))
+        outputs = (
+            p
+            | "Creating queries" >> beam.Create([jobs])
+            | "Reading from Cloud SQL" >> beam.ParDo(self.read_from_postgres_async).with_outputs(*extracted)
+        )
+        for table_name in extracted:
+            print(f"Creating tables for {table_name}", flush=True)
+            self.warehouse.get_or_create_table(table_name)
+            table_id = self.warehouse.get_or_create_table(table_name, staging=True)
+            self.stage_rows(outputs[table_name], table_name, table_id)
+
+    def check_fingerprints(self, tables):
+        fingerprint_store = FingerprintStore(self.fingerprint_path)
+        for table_name in tables:
+            if table_name in DIMENSIONS:
+                fingerprint_store.check_target(table_name, self.warehouse.table_identity(table_name))
+        fingerprint_store.close()
+
+    def stage_rows(self, rows, table_name, table_id, staging_prefix=None):
+        if table_name in self.raw_tables:
+            rows = rows | f"Deriving {table_name} columns" >> beam.ParDo(
+                DeriveColumns(table_name, date.today(), self.get_enum_maps(), self.output_format)
+            )
+        if self.fingerprint_path and table_name in DIMENSIONS:
+            rows = rows | f"Dropping unchanged {table_name} rows" >> beam.ParDo(
+                DropUnchangedRows(table_name, self.fingerprint_path, self.run_id)
+            )
+        self.write_staging(rows, table_name, table_id, staging_prefix)
+
+    def write_staging(self, rows, table_name, table_id, staging_prefix=None):
+        if self.sink == "streaming_inserts":
+            if self.output_format == "batches":
+                rows = rows | f"Unbatching {table_name} rows" >> beam.FlatMap(to_rows)
+            rows | f"Writing {table_name} to the temporary BigQuery table" >> WriteToBigQuery(
                 table_id,
                 write_disposition=BigQueryDisposition.WRITE_APPEND,
                 method="STREAMING_INSERTS",
             )
-        )
+        else:
+            rows | f"Writing {table_name} to staging files" >> beam.ParDo(
+                WriteParquetFiles(
+                    table_name,
+                    staging_prefix or self.get_staging_prefix(table_name),
+                    row_group_size=self.row_group_size,
+                    max_file_bytes=self.max_file_bytes,
+                )
+            )
 
+    def get_staging_prefix(self, table_name):
+        return f"{self.staging_path}/{self.run_id}/{table_name}"
+
+    def load_staging_tables(self, tables):
+        jobs = []
+        for table_name in tables:
+            print(f"Loading staged files into {self.warehouse.table_id(table_name, staging=True)}", flush=True)
+            job = self.warehouse.load_files(table_name, staged_files(self.get_staging_prefix(table_name)))
+            jobs.append((table_name, job))
+        for table_name, job in jobs:
+            if job is not None:
+                job.result()
+                self.metrics.record_load_job(table_name, job)
+            self.ledger.mark(table_name, "staged")
+
+
+    def reset_staging_output(self, table_name):
+        # Whatever an interrupted extraction left behind would be loaded twice.
+        if self.sink == "streaming_inserts":
+            self.warehouse.truncate_staging_table(table_name)
+        else:
+            delete_staged_files(self.get_staging_prefix(table_name))
+
+    def reset_staging_outputs(self, tables):
+        if self.sink == "streaming_inserts":
+            # The tables prepare_tables created are emptied, not dropped.
+            self.warehouse.truncate_staging_tables(tables)
+            return
+        with ThreadPoolExecutor(max_workers=self.max_concurrent_pipelines) as executor:
+            list(executor.map(self.reset_staging_output, tables))
+
+    def mark_extracted(self, tables):
+        # Streaming inserts land in the staging table during the pipeline.
+        stages = ("extracted", "staged") if self.sink == "streaming_inserts" else ("extracted",)
+        for table_name in tables:
+            self.ledger.mark(table_name, *stages)
+
+    def run_table_pipeline(self, table_name, start_date):
+        if not self.ledger.done(table_name, "extracted"):
+            self.reset_staging_output(table_name)
+            pipeline = beam.Pipeline(options=self.pipeline_options)
+            self.create_pipeline(table_name, start_date, pipeline)
+            print(f"Running pipeline for {table_name}", flush=True)
+            with self.metrics.stage(table_name, "extract"):
+                result = pipeline.run()
+                result.wait_until_finish()
+            self.metrics.record_pipeline(result, [table_name])
+            self.mark_extracted([table_name])
+        if not self.ledger.done(table_name, "staged"):
+            self.load_staging_tables([table_name])
+
+    def run_table_pipelines(self, tables, start_dates):
+        with ThreadPoolExecutor(max_workers=self.max_concurrent_pipelines) as executor:
+            loaded = {
+                table_name: executor.submit(self.run_table_pipeline, table_name, start_dates[table_name])
+                for table_name in tables
+            }
+            self.merge_tables(self.ledger.pending(tables + self.rollups_for(tables), "merged"), ready=loaded)
+
+    def start_run(self):
+        self.enum_maps = None
+        run = self.ledger.resume()
+        if run is not None:
+            self.run_id = run["run_id"]
+            print(f"Resuming run {self.run_id}", flush=True)
+            if (
+                self.date_source == "calendar"
+                and "date" in run["start_dates"]
+                and not self.ledger.done("date", "extracted")
+            ):
+                self.calendar_rows = self.get_calendar_rows()
+            self.metrics.start(self.run_id)
+            return run["start_dates"], run["watermarks"]
+
+        start_dates, new_watermarks = self.get_start_dates(list(TABLES))
+        self.run_id = datetime.now().strftime("%Y%m%dT%H%M%S")
+        self.metrics.start(self.run_id)
+        self.ledger.start(self.run_id, start_dates, new_watermarks)
+        return start_dates, new_watermarks
 
     def run_pipeline(self):
-        try:
-            blob = storage.Blob("last_run.txt", self.bucket)
-            start_date = blob.download_as_text().strip()
-        except (NotFound, ValueError):
-            start_date = "1900-01-01"
-            
-        self.bigquery_client.create_dataset(dataset=secrets.INSTANCE_ID, exists_ok=True)
-        self.bigquery_client.create_dataset(dataset=f"{secrets.INSTANCE_ID}_staging", exists_ok=True)
-
-        queries = self.get_query(start_date, get_all=True).keys()
+        self.warehouse.create_datasets()
+
+        start_dates, new_watermarks = self.start_run()
+        queries = list(start_dates)
+        if self.pipeline_per_table and self.table_order == "longest_first":
+            queries = self.metrics.longest_first(queries)
+            print(f"Extraction order: {', '.join(queries)}", flush=True)
+        to_extract = self.ledger.pending(queries, "extracted")
+        if {"work", "publisher", "author", "work_author"} & set(to_extract):
+            self.load_active_works()
+        with self.metrics.stage(None, "staging_setup"):
+            self.warehouse.prepare_tables(self.ledger.pending(queries, "merged"))
         # for query in queries:
         #     table_id = f"{secrets.PROJECT_ID}.{secrets.INSTANCE_ID}_staging.{query}_temp"
         #     print(f"truncating {table_id}", flush=True)
         #     client.query(f"DELETE FROM {table_id} WHERE TRUE").result()
 
-        ran_at = datetime.now()
-        print(start_date)
+        print(start_dates)
         # start_date = "1900-01-01"
 
-        for query in queries:
-            self.create_pipeline(query, start_date)
-
-        print("Running pipeline", flush=True)
-        result = self.p.run()
-        result.wait_until_finish()
-
-        futures = []
-        for query in queries:
-            futures.append(self.generate_merge_sql(query, schemas[query]))
-
-        for future in futures:
-            future.result()
-
-        blob = storage.Blob("last_run.txt", self.bucket)
-        blob.upload_from_string(str(ran_at))
+        if self.fingerprint_path:
+            # Hashes staged by a run that never reached its MERGE are stale.
+            fingerprint_store = FingerprintStore(self.fingerprint_path)
+            fingerprint_store.discard_pending(keep_run_id=self.run_id)
+            fingerprint_store.close()
+            self.check_fingerprints(to_extract)
+
+        if self.pipeline_per_table:
+            self.run_table_pipelines(queries, start_dates)
+        else:
+            self.reset_staging_outputs(to_extract)
+            if self.extractor == "async":
+                self.create_async_pipeline(to_extract, start_dates)
+            else:
+                for query in to_extract:
+                    self.create_pipeline(query, start_dates[query])
+
+            if to_extract:
+                print("Running pipeline", flush=True)
+                # One pipeline extracts every table, so its wall time is
+                # run-wide; per-table numbers come from the Beam counters.
+                with self.metrics.stage(None, "extract"):
+                    result = self.p.run()
+                    result.wait_until_finish()
+                self.metrics.record_pipeline(result, to_extract)
+                self.mark_extracted(to_extract)
+
+            if self.sink != "streaming_inserts":
+                self.load_staging_tables(self.ledger.pending(queries, "staged"))
+
+            self.merge_tables(self.ledger.pending(queries + self.rollups_for(queries), "merged"))
+
+        if self.fingerprint_path:
+            fingerprint_store = FingerprintStore(self.fingerprint_path)
+            for query in queries:
+                fingerprint_store.commit(self.run_id, query)
+            fingerprint_store.close()
+
+        self.watermarks.save(new_watermarks)
         
-        self.set_keys()
+        with self.metrics.stage(None, "keys"):
+            self.set_keys()
         
-        self.bigquery_client.delete_dataset(f"{secrets.INSTANCE_ID}_staging", delete_contents=True, not_found_ok=True) 
-        self.bigquery_client.create_dataset(dataset=f"{secrets.INSTANCE_ID}_staging", exists_ok=True)
-        for query in queries:
-            self.get_or_create_table(query, staging=True)
+        # The staging tables stay: the next load into them replaces their
+        # rows, and streaming inserts truncate them before extracting again.
+        with self.metrics.stage(None, "staging_reset"):
+            if self.sink != "streaming_inserts":
+                self.reset_staging_outputs(queries)
+
+        self.metrics.write_report()
+        self.ledger.finish()
 
     def main(self):
         self.run_pipeline()
@@ -0,0 +1,102 @@
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from bigquery_schemas import schemas
+
+
+def referenced_tables(table_name):
+    return {
+        field.description.split()[-1]
+        for field in schemas[table_name]
+        if field.description and "FK" in field.description
+    }
+
+
+# Only tables merged in this run take part in the ordering; a dimension that
+# was skipped has nothing to merge and does not hold its facts back.
+# dependencies adds edges the schemas do not describe, and covers names that
+# are not in the schemas (rollups).
+def dependency_graph(tables, dependencies=None):
+    tables = set(tables)
+    dependencies = dependencies or {}
+    return {
+        table: ((referenced_tables(table) if table in schemas else set()) | dependencies.get(table, set()))
+        & (tables - {table})
+        for table in tables
+    }
+
+
+class MergeScheduler:
+    def __init__(self, submit, max_concurrency=4, retries=2, backoff=5.0, on_merged=None, dependencies=None):
+        # submit(table_name) starts the MERGE and returns a job with .result(),
+        # on_merged(table_name, job) is called once it succeeded.
+        self.submit = submit
+        self.on_merged = on_merged
+        self.dependencies = dependencies
+        self.max_concurrency = max_concurrency
+        self.retries = retries
+        self.backoff = backoff
+
+    def _merge(self, table_name):
+        for attempt in range(self.retries + 1):
+            try:
+                job = self.submit(table_name)
+                job.result()
+                return job
+            except Exception as e:
+                if attempt == self.retries:
+                    raise
+                delay = self.backoff * 2 ** attempt
+                print(f"Merging {table_name} failed ({e}), retrying in {delay:.0f}s", flush=True)
+                time.sleep(delay)
+
+    # ready optionally maps tables to futures (e.g. their own pipeline and
+    # staging load) that have to finish before the table can be merged.
+    def run(self, tables, ready=None):
+        ready = ready or {}
+        graph = dependency_graph(tables, self.dependencies)
+        pending = set(graph)
+        done, failed, running = {}, {}, {}
+
+        with ThreadPoolExecutor(max_workers=self.max_concurrency) as executor:
+            while pending or running:
+                waiting = len(pending)
+                for table_name in sorted(pending):
+                    upstream = ready.get(table_name)
+                    if graph[table_name] & failed.keys():
+                        failed[table_name] = RuntimeError(
+                            f"skipped, {', '.join(sorted(graph[table_name] & failed.keys()))} failed"
+                        )
+                        pending.discard(table_name)
+                    elif upstream is not None and upstream.done() and upstream.exception() is not None:
+                        print(f"Loading {table_name} failed: {upstream.exception()}", flush=True)
+                        failed[table_name] = upstream.exception()
+                        pending.discard(table_name)
+                    elif graph[table_name] <= done.keys() and (upstream is None or upstream.done()):
+                        running[executor.submit(self._merge, table_name)] = table_name
+                        pending.discard(table_name)
+
+                loading = [ready[table] for table in pending if table in ready and not ready[table].done()]
+                if not running and not loading:
+                    if len(pending) == waiting:
+                        raise RuntimeError(f"Circular FK references between {', '.join(sorted(pending))}")
+                    continue
+                finished, _ = wait([*running, *loading], return_when=FIRST_COMPLETED)
+                for future in finished:
+                    if future not in running:
+                        continue
+                    table_name = running.pop(future)
+                    try:
+                        done[table_name] = future.result()
+                    except Exception as e:
+                        print(f"Merging {table_name} failed: {e}", flush=True)
+                        failed[table_name] = e
+                        continue
+                    if self.on_merged is not None:
+                        self.on_merged(table_name, done[table_name])
+
+        if failed:
+            raise RuntimeError(
+                "MERGE failed for " + "; ".join(f"{table}: {error}" for table, error in sorted(failed.items()))
+            )
+        return done
@@ -1,3 +1,13 @@
+# Works that were ever loaned, rated or listed. Computed once per run and
+# passed to the dimension queries below as :active_work_ids.
+active_works = """
+    SELECT ii.work_id FROM loan JOIN inventory_item ii USING (item_id)
+    UNION
+    SELECT work_id FROM rating
+    UNION
+    SELECT work_id FROM listing
+"""
+
 work = """
     SELECT 
         w.work_id,
@@ -18,13 +28,9 @@ work = """
             work_id
     ) s USING (work_id)
     WHERE
-        w.modified_at > '{start_date}'
+        w.modified_at > :start_date
     AND
-    (
-        EXISTS (SELECT 1 FROM loan JOIN inventory_item ii USING (item_id) WHERE ii.work_id = w.work_id)
-        OR EXISTS (SELECT 1 FROM rating r WHERE r.work_id = w.work_id)
-        OR EXISTS (SELECT 1 FROM listing l WHERE l.work_id = w.work_id)
-    )
+        w.work_id = ANY(CAST(:active_work_ids AS INTEGER[]))
 """
 
 publisher = """
@@ -34,13 +40,9 @@ publisher = """
     FROM
         publisher p
     WHERE
-        p.modified_at > '{start_date}'
+        p.modified_at > :start_date
     AND
-    (
-        EXISTS (SELECT 1 FROM loan JOIN inventory_item ii USING (item_id) join work w using(work_id) WHERE w.publisher_id = p.publisher_id)
-        OR EXISTS (SELECT 1 FROM rating r join work w using(work_id) WHERE p.publisher_id = w.publisher_id)
-        OR EXISTS (SELECT 1 FROM listing l join work w using(work_id) WHERE p.publisher_id = w.publisher_id)
-    )
+        EXISTS (SELECT 1 FROM work w WHERE w.publisher_id = p.publisher_id AND w.work_id = ANY(CAST(:active_work_ids AS INTEGER[])))
 
 """
 author = """
@@ -50,13 +52,9 @@ author = """
     FROM
         author a
     WHERE
-        a.modified_at > '{start_date}'
+        a.modified_at > :start_date
     AND
-    (
-        EXISTS (SELECT 1 FROM loan JOIN inventory_item ii USING (item_id) join work_author wa using(work_id) WHERE wa.author_id = a.author_id)
-        OR EXISTS (SELECT 1 FROM rating r join work w using(work_id) join work_author wa using(work_id) WHERE wa.author_id = a.author_id)
-        OR EXISTS (SELECT 1 FROM listing l join work w using(work_id) join work_author wa using(work_id) WHERE wa.author_id = a.author_id)
-    )
+        EXISTS (SELECT 1 FROM work_author wa WHERE wa.author_id = a.author_id AND wa.work_id = ANY(CAST(:active_work_ids AS INTEGER[])))
 
 """
 
@@ -72,13 +70,9 @@ work_author = """
     USING
         (work_id)
     WHERE 
-        added_at > '{start_date}'
+        added_at > :start_date
     AND
-    (
-        EXISTS (SELECT 1 FROM loan JOIN inventory_item ii USING (item_id) WHERE ii.work_id = w.work_id)
-        OR EXISTS (SELECT 1 FROM rating r WHERE r.work_id = w.work_id)
-        OR EXISTS (SELECT 1 FROM listing l WHERE l.work_id = w.work_id)
-    )
+        w.work_id = ANY(CAST(:active_work_ids AS INTEGER[]))
 
 """
 
@@ -89,7 +83,7 @@ subject = """
     from 
         subject
     where
-        modified_at > '{start_date}'
+        modified_at > :start_date
 
 """
 
@@ -99,7 +93,7 @@ language = """
     from
         lang
     WHERE 
-        modified_at > '{start_date}'
+        modified_at > :start_date
 
 """
 
@@ -111,11 +105,11 @@ date = """
         date::date AS date, 
         TO_CHAR(date, 'YYYYMMDD')::INTEGER AS date_id
     FROM (
-        SELECT loaned_at::date as date FROM loan WHERE loaned_at > '{start_date}'
+        SELECT loaned_at::date as date FROM loan WHERE loaned_at > :start_date AND loaned_at <= :end_date
         union
-        SELECT rated_at::date as date FROM rating  WHERE rated_at > '{start_date}'
+        SELECT rated_at::date as date FROM rating  WHERE rated_at > :start_date AND rated_at <= :end_date
         union
-        SELECT listed_at::date as date FROM listing WHERE listed_at > '{start_date}'
+        SELECT listed_at::date as date FROM listing WHERE listed_at > :start_date AND listed_at <= :end_date
     ) x
 
 """
@@ -213,10 +207,144 @@ FROM
         ON
             enumlabel = medium::text
         WHERE
-            loaned_at > '{start_date}'
+            loaned_at > :start_date
+        AND
+            loaned_at <= :end_date
+    ) AS subquery
+WHERE
+    items_left >= 0
+-- Several returns of one work by one user on the same day keep the latest
+-- loan, the same row in every formulation.
+ORDER BY
+    work_id, user_id, date_id, loaned_at DESC, days_loaned, medium_id
+"""
+
+# Same rows as return_fact, but items_left comes from one running sum per work
+# instead of re-joining inventory_item/loan/loan_return for every returned loan.
+# For a loan taken at t the correlated query counts
+#   (items loaned at least once by t) - (loans taken by t) + (those returned by t)
+# which is exactly the sum of these events up to and including t:
+#   +1 at an item's first loan, -1 at every loan, +1 at every return
+#   (a return counts once both its loan and its return are <= t).
+# Probe rows (delta 0) at each returned loan's loaned_at read the running sum.
+return_fact_sweep = """
+WITH returned AS (
+    SELECT
+        work.pages,
+        EXTRACT('Day' FROM returned_at - loaned_at) AS days_loaned,
+        EXTRACT(YEAR FROM CURRENT_DATE) - release_year AS work_age,
+        EXTRACT(YEAR FROM AGE(now(), birthday))::INTEGER AS reader_age,
+        library_user.user_id, TO_CHAR(returned_at, 'YYYYMMDD')::INTEGER AS date_id,
+        work.work_id,
+        enumsortorder AS medium_id,
+        work.language_id,
+        medium,
+        loaned_at
+    FROM
+        loan_return
+    JOIN
+        loan l1
+    USING
+        (loan_id)
+    JOIN
+        inventory_item
+    USING
+        (item_id)
+    JOIN
+        work
+    USING
+        (work_id)
+    JOIN
+        library_user
+    USING
+        (user_id)
+    JOIN
+        pg_enum
+    ON
+        enumlabel = medium::text
+    WHERE
+        loaned_at > :start_date
+    AND
+        loaned_at <= :end_date
+),
+history AS (
+    SELECT
+        ii.work_id,
+        ii.item_id,
+        l.loaned_at,
+        lr.returned_at
+    FROM
+        inventory_item ii
+    JOIN
+        loan l
+    USING
+        (item_id)
+    LEFT JOIN
+        loan_return lr
+    USING
+        (loan_id)
+    WHERE
+        ii.work_id IN (SELECT work_id FROM returned)
+    AND
+        l.loaned_at IS NOT NULL
+),
+events AS (
+    SELECT work_id, MIN(loaned_at) AS at, 1 AS delta FROM history GROUP BY work_id, item_id
+    UNION ALL
+    SELECT work_id, loaned_at, -1 FROM history
+    UNION ALL
+    SELECT work_id, GREATEST(loaned_at, returned_at), 1 FROM history WHERE returned_at IS NOT NULL
+    UNION ALL
+    SELECT DISTINCT work_id, loaned_at, 0 FROM returned
+),
+sweep AS (
+    SELECT
+        work_id,
+        at,
+        delta,
+        SUM(delta) OVER (PARTITION BY work_id ORDER BY at) AS available
+    FROM
+        events
+)
+SELECT DISTINCT ON (work_id, user_id, date_id) 
+    pages,
+    items_left,
+    days_loaned,
+    work_age,
+    reader_age,
+    user_id,
+    date_id,
+    work_id,
+    medium_id,
+    language_id
+FROM 
+    (
+        SELECT
+            r.*,
+            CASE 
+                WHEN 
+                    medium IN ('EBOOK', 'AUDIOBOOK')
+                THEN 1
+            ELSE 
+                s.available
+            END AS items_left
+        FROM
+            returned r
+        JOIN
+            sweep s
+        ON
+            s.work_id = r.work_id
+        AND
+            s.at = r.loaned_at
+        AND
+            s.delta = 0
     ) AS subquery
 WHERE
     items_left >= 0
+-- Several returns of one work by one user on the same day keep the latest
+-- loan, the same row in every formulation.
+ORDER BY
+    work_id, user_id, date_id, loaned_at DESC, days_loaned, medium_id
 """
 
 rating_fact = """
@@ -240,7 +368,9 @@ rating_fact = """
     using 
         (user_id)
     where 
-        rated_at > '{start_date}'
+        rated_at > :start_date
+    and
+        rated_at <= :end_date
     and 
         birthday < rated_at
 """
@@ -270,7 +400,9 @@ listing_fact = """
     using 
         (user_id)
     where 
-        listed_at > '{start_date}'
+        listed_at > :start_date
+    and
+        listed_at <= :end_date
     and 
         birthday < listed_at
 """
@@ -286,7 +418,7 @@ WITH age_calculation AS (
     FROM 
         library_user 
     WHERE 
-        modified_at > '{start_date}'
+        modified_at > :start_date
 )
 SELECT 
     user_id,
@@ -309,3 +441,295 @@ SELECT
 FROM 
     age_calculation
 """
+
+# Raw-column variants for DataPipeline(query_mode="raw"). They return the
+# source columns the derived ones are computed from (birthday, release_year,
+# returned_at, enum labels, ...) and leave the per-row expressions to
+# derivations.py, so Postgres only joins and filters. A change to a derived
+# query needs the same change here; tests/test_derivations.py checks that
+# both modes return the same rows.
+raw_user = """
+    SELECT
+        user_id,
+        birthday,
+        gender,
+        first_name,
+        last_name
+    FROM
+        library_user
+    WHERE
+        modified_at > :start_date
+"""
+
+raw_date = """
+    SELECT loaned_at::date as date FROM loan WHERE loaned_at > :start_date AND loaned_at <= :end_date
+    union
+    SELECT rated_at::date as date FROM rating  WHERE rated_at > :start_date AND rated_at <= :end_date
+    union
+    SELECT listed_at::date as date FROM listing WHERE listed_at > :start_date AND listed_at <= :end_date
+"""
+
+raw_return_fact = """
+SELECT DISTINCT ON (work_id, user_id, returned_at::date) 
+    pages,
+    items_left,
+    loaned_at,
+    returned_at,
+    release_year,
+    birthday,
+    user_id,
+    work_id,
+    medium,
+    language_id
+FROM 
+    (
+        SELECT
+            work.pages,
+            returned_at,
+            release_year,
+            birthday,
+            library_user.user_id,
+            work.work_id,
+            medium::text AS medium,
+            work.language_id,
+            loaned_at,
+            (  
+                SELECT
+                    CASE 
+                        WHEN 
+                            medium IN ('EBOOK', 'AUDIOBOOK')
+                        THEN 1
+                    ELSE 
+                        (COUNT(DISTINCT ii.item_id) - COUNT(CASE WHEN loaned_at IS NULL THEN 1 END) + COUNT(returned_at) - COUNT(loaned_at))
+                    END AS items_left
+                FROM
+                    inventory_item ii
+                LEFT JOIN
+                    loan l
+                    ON 
+                        l.item_id = ii.item_id
+                    AND
+                        loaned_at <= l1.loaned_at
+                LEFT JOIN
+                    loan_return lr
+                    ON
+                        lr.loan_id = l.loan_id
+                    AND
+                        returned_at <= l1.loaned_at
+                WHERE
+                    ii.work_id = work.work_id
+            )
+        FROM
+            loan_return
+        JOIN
+            loan l1
+        USING
+            (loan_id)
+        JOIN
+            inventory_item
+        USING
+            (item_id)
+        JOIN
+            work
+        USING
+            (work_id)
+        JOIN
+            library_user
+        USING
+            (user_id)
+        WHERE
+            loaned_at > :start_date
+        AND
+            loaned_at <= :end_date
+    ) AS subquery
+WHERE
+    items_left >= 0
+ORDER BY
+    work_id, user_id, returned_at::date, loaned_at DESC, returned_at, medium
+"""
+
+raw_return_fact_sweep = """
+WITH returned AS (
+    SELECT
+        work.pages,
+        returned_at,
+        release_year,
+        birthday,
+        library_user.user_id,
+        work.work_id,
+        work.language_id,
+        medium,
+        loaned_at
+    FROM
+        loan_return
+    JOIN
+        loan l1
+    USING
+        (loan_id)
+    JOIN
+        inventory_item
+    USING
+        (item_id)
+    JOIN
+        work
+    USING
+        (work_id)
+    JOIN
+        library_user
+    USING
+        (user_id)
+    WHERE
+        loaned_at > :start_date
+    AND
+        loaned_at <= :end_date
+),
+history AS (
+    SELECT
+        ii.work_id,
+        ii.item_id,
+        l.loaned_at,
+        lr.returned_at
+    FROM
+        inventory_item ii
+    JOIN
+        loan l
+    USING
+        (item_id)
+    LEFT JOIN
+        loan_return lr
+    USING
+        (loan_id)
+    WHERE
+        ii.work_id IN (SELECT work_id FROM returned)
+    AND
+        l.loaned_at IS NOT NULL
+),
+events AS (
+    SELECT work_id, MIN(loaned_at) AS at, 1 AS delta FROM history GROUP BY work_id, item_id
+    UNION ALL
+    SELECT work_id, loaned_at, -1 FROM history
+    UNION ALL
+    SELECT work_id, GREATEST(loaned_at, returned_at), 1 FROM history WHERE returned_at IS NOT NULL
+    UNION ALL
+    SELECT DISTINCT work_id, loaned_at, 0 FROM returned
+),
+sweep AS (
+    SELECT
+        work_id,
+        at,
+        delta,
+        SUM(delta) OVER (PARTITION BY work_id ORDER BY at) AS available
+    FROM
+        events
+)
+SELECT DISTINCT ON (work_id, user_id, returned_at::date) 
+    pages,
+    items_left,
+    loaned_at,
+    returned_at,
+    release_year,
+    birthday,
+    user_id,
+    work_id,
+    medium::text AS medium,
+    language_id
+FROM 
+    (
+        SELECT
+            r.*,
+            CASE 
+                WHEN 
+                    medium IN ('EBOOK', 'AUDIOBOOK')
+                THEN 1
+            ELSE 
+                s.available
+            END AS items_left
+        FROM
+            returned r
+        JOIN
+            sweep s
+        ON
+            s.work_id = r.work_id
+        AND
+            s.at = r.loaned_at
+        AND
+            s.delta = 0
+    ) AS subquery
+WHERE
+    items_left >= 0
+ORDER BY
+    work_id, user_id, returned_at::date, loaned_at DESC, returned_at, medium
+"""
+
+raw_rating_fact = """
+    select distinct on (work_id, user_id)
+        pages,
+        score,
+        release_year,
+        birthday,
+        user_id,
+        rated_at,
+        work_id,
+        language_id
+    from
+        rating 
+    join 
+        work
+    using
+        (work_id)
+    join
+        library_user
+    using 
+        (user_id)
+    where 
+        rated_at > :start_date
+    and
+        rated_at <= :end_date
+    and 
+        birthday < rated_at
+"""
+
+raw_listing_fact = """
+    select distinct on (work_id, user_id, reading_status)
+        pages,
+        release_year,
+        birthday,
+        user_id,
+        listed_at,
+        work_id,
+        language_id,
+        reading_status::text as reading_status
+    from
+        listing 
+    join 
+        work
+    using
+        (work_id)
+    join
+        library_user
+    using 
+        (user_id)
+    where 
+        listed_at > :start_date
+    and
+        listed_at <= :end_date
+    and 
+        birthday < listed_at
+"""
+
+# Label -> enumsortorder of the enums behind medium_id and listing_type_id,
+# read once per run in raw mode.
+enum_labels = """
+    SELECT
+        t.typname,
+        e.enumlabel,
+        e.enumsortorder
+    FROM
+        pg_enum e
+    JOIN
+        pg_type t
+    ON
+        t.oid = e.enumtypid
+    WHERE
+        t.typname IN ('item_medium_type', 'reading_status_type')
+"""
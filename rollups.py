@@ -0,0 +1,173 @@
+from warehouse import key_fields, merge_sql
+
+
+# An additive aggregate of a fact table for the dashboards, e.g. loans per
+# month, subject, age group and medium. `keys` maps the rollup's columns to
+# (dimension table, column), or (None, column) for a column of the fact
+# itself; dimensions are joined on their PK. `measures` maps columns to the
+# fact column they sum, None counting rows; every rollup needs such a row
+# count, which tells when a group is empty.
+#
+# Every fact row is kept in <name>_rows, clustered on the fact's PK, with the
+# group it is counted in, i.e. its dimensions as of the run that merged it.
+# A run joins its staged fact rows to <name>_rows on the PK and merges the
+# difference into the rollup: each staged row adds itself to its new group
+# and takes its old version out of the group it was counted in. Then the
+# staged rows are upserted into <name>_rows, all in one transaction. The
+# refresh reads the staged rows and its own tables only, so it can run
+# before or after the fact's MERGE (after the dimensions it groups by), and
+# running it again for the same staged rows changes nothing.
+class Rollup:
+    def __init__(self, name, fact, keys, measures):
+        self.name = name
+        self.fact = fact
+        self.keys = keys
+        self.measures = measures
+        self.rows_name = f"{name}_rows"
+        counts = [measure for measure, column in measures.items() if column is None]
+        if not counts:
+            raise ValueError(f"{name} needs a measure counting rows")
+        self.count = counts[0]
+
+    def dimensions(self):
+        return {table_name for table_name, _ in self.keys.values() if table_name is not None}
+
+    def row_columns(self, quote=str):
+        # Columns of <name>_rows: the fact's PK, the group and the values
+        # the measures sum.
+        columns = {column: f"F.{quote(column)}" for column in key_fields(self.fact)}
+        expressions = [
+            (name, f"{'F' if table_name is None else f'D_{table_name}'}.{quote(column)}")
+            for name, (table_name, column) in self.keys.items()
+        ]
+        # NULLs sum as 0, so adding and taking out a row's values is exact.
+        expressions += [
+            (name, "1" if column is None else f"COALESCE(F.{quote(column)}, 0)")
+            for name, column in self.measures.items()
+        ]
+        for name, expression in expressions:
+            if columns.setdefault(name, expression) != expression:
+                raise ValueError(f"{self.name}.{name} is both {columns[name]} and {expression}")
+        return columns
+
+    def rows(self, table_id, quote=str, staging=True):
+        # table_id(table_name, staging=False) returns a quoted table id.
+        joins = "".join(
+            f"\n            LEFT JOIN {table_id(table_name)} AS D_{table_name} "
+            f"ON D_{table_name}.{quote(key_fields(table_name)[0])} = F.{quote(key_fields(table_name)[0])}"
+            for table_name in sorted(self.dimensions())
+        )
+        selected = ", ".join(f"{expression} AS {quote(name)}" for name, expression in self.row_columns(quote).items())
+        return f"""
+            SELECT {selected}
+            FROM {table_id(self.fact, staging=staging)} AS F{joins}
+        """
+
+    def select(self, table_id, quote=str):
+        keys = ", ".join(quote(name) for name in self.keys)
+        selected = ", ".join([keys] + [f"SUM({quote(name)}) AS {quote(name)}" for name in self.measures])
+        return f"""
+            SELECT {selected}
+            FROM {table_id(self.rows_name)}
+            GROUP BY {keys}
+        """
+
+    def delta(self, table_id, quote=str):
+        # Per group, what the staged rows add minus what their previous
+        # versions in <name>_rows contributed.
+        keys = ", ".join(quote(name) for name in self.keys)
+        matched = " AND ".join(f"R.{quote(column)} = S.{quote(column)}" for column in key_fields(self.fact))
+        old = ", ".join(
+            [f"R.{quote(name)}" for name in self.keys] + [f"-R.{quote(name)} AS {quote(name)}" for name in self.measures]
+        )
+        new = ", ".join([keys] + [quote(name) for name in self.measures])
+        return f"""
+            SELECT {keys}, {", ".join(f"SUM({quote(name)}) AS {quote(name)}" for name in self.measures)}
+            FROM (
+                SELECT {old}
+                FROM {table_id(self.rows_name)} AS R
+                JOIN {table_id(self.fact, staging=True)} AS S ON {matched}
+                UNION ALL
+                SELECT {new} FROM ({self.rows(table_id, quote)}) AS N
+            ) AS C
+            GROUP BY {keys}
+        """
+
+    def create(self, table_id, quote=str, cluster=False):
+        # Statements creating the tables from the merged facts, run outside
+        # the refresh transaction; both are no-ops once the tables exist.
+        # cluster=True clusters <name>_rows on the fact's PK (BigQuery).
+        cluster_by = ""
+        if cluster:
+            cluster_by = f" CLUSTER BY {', '.join(quote(column) for column in key_fields(self.fact)[:4])}"
+        return [
+            f"CREATE TABLE IF NOT EXISTS {table_id(self.rows_name)}{cluster_by} AS "
+            f"{self.rows(table_id, quote, staging=False)}",
+            f"CREATE TABLE IF NOT EXISTS {table_id(self.name)} AS {self.select(table_id, quote)}",
+        ]
+
+    def refresh(self, table_id, quote=str):
+        # Statements of the refresh transaction; the first one merges the
+        # delta into the rollup. Groups whose row count drops to zero are
+        # deleted.
+        matched = " AND ".join(
+            f"TARGET.{quote(name)} IS NOT DISTINCT FROM SOURCE.{quote(name)}" for name in self.keys
+        )
+        count = quote(self.count)
+        columns = [*self.keys, *self.measures]
+        return [
+            f"""
+            MERGE INTO {table_id(self.name)} AS TARGET
+            USING ({self.delta(table_id, quote)}) AS SOURCE
+            ON {matched}
+            WHEN MATCHED AND TARGET.{count} + SOURCE.{count} = 0 THEN
+                DELETE
+            WHEN MATCHED THEN
+                UPDATE SET {", ".join(f"{quote(name)} = TARGET.{quote(name)} + SOURCE.{quote(name)}" for name in self.measures)}
+            WHEN NOT MATCHED AND SOURCE.{count} <> 0 THEN
+                INSERT ({", ".join(quote(name) for name in columns)})
+                VALUES ({", ".join(f"SOURCE.{quote(name)}" for name in columns)})
+            """,
+            merge_sql(
+                table_id(self.rows_name),
+                f"({self.rows(table_id, quote)})",
+                list(self.row_columns()),
+                key_fields(self.fact),
+                quote=quote,
+            ),
+        ]
+
+
+ROLLUPS = {}
+
+
+def register(name, fact, keys, measures):
+    ROLLUPS[name] = Rollup(name, fact, keys, measures)
+    return ROLLUPS[name]
+
+
+MONTH_SUBJECT_AGE = {
+    "year": ("date", "year"),
+    "month": ("date", "month"),
+    "subject_id": ("work", "subject_id"),
+    "age_group": ("user", "age_group"),
+}
+
+register(
+    "monthly_loans",
+    "return_fact",
+    {**MONTH_SUBJECT_AGE, "medium_id": (None, "medium_id")},
+    {"loans": None, "pages": "pages", "days_loaned": "days_loaned"},
+)
+register(
+    "monthly_ratings",
+    "rating_fact",
+    MONTH_SUBJECT_AGE,
+    {"ratings": None, "score_total": "score"},
+)
+register(
+    "monthly_listings",
+    "listing_fact",
+    {**MONTH_SUBJECT_AGE, "listing_type_id": (None, "listing_type_id")},
+    {"listings": None},
+)
@@ -0,0 +1,49 @@
+import threading
+
+STAGES = ("extracted", "staged", "merged")
+
+
+# Per-table stage completion of the current run, kept in the state store.
+# A run that fails part-way leaves its ledger open; the next run picks it up
+# with the same run id and extraction window and skips whatever is done.
+class RunLedger:
+    def __init__(self, store, name="run_ledger.json"):
+        self.store = store
+        self.name = name
+        self.run = None
+        self._lock = threading.Lock()
+
+    def resume(self):
+        run = self.store.read(self.name, default=None)
+        if run is None or run.get("finished"):
+            return None
+        self.run = run
+        return run
+
+    def start(self, run_id, start_dates, watermarks):
+        self.run = {
+            "run_id": run_id,
+            "start_dates": start_dates,
+            "watermarks": watermarks,
+            "tables": {table_name: [] for table_name in start_dates},
+            "finished": False,
+        }
+        self.store.write(self.name, self.run)
+        return self.run
+
+    def done(self, table_name, stage):
+        return stage in self.run["tables"].get(table_name, [])
+
+    def pending(self, tables, stage):
+        return [table_name for table_name in tables if not self.done(table_name, stage)]
+
+    def mark(self, table_name, *stages):
+        with self._lock:
+            completed = self.run["tables"].setdefault(table_name, [])
+            completed.extend(stage for stage in stages if stage not in completed)
+            self.store.write(self.name, self.run)
+
+    def finish(self):
+        with self._lock:
+            self.run["finished"] = True
+            self.store.write(self.name, self.run)
@@ -0,0 +1,281 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+from apache_beam.metrics import Metrics
+from apache_beam.metrics.metric import MetricsFilter
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+def peak_rss_mb(who="self"):
+    # Peak over the lifetime of this process, or the largest peak of its
+    # finished child processes (e.g. multi_processing workers).
+    if resource is None:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN if who == "children" else resource.RUSAGE_SELF)
+    # ru_maxrss is kilobytes on Linux.
+    return round(usage.ru_maxrss / 1024, 1)
+
+
+def _children(pid):
+    children = []
+    try:
+        for task in os.listdir(f"/proc/{pid}/task"):
+            with open(f"/proc/{pid}/task/{task}/children") as f:
+                children += [int(child) for child in f.read().split()]
+    except OSError:
+        pass
+    return children
+
+
+def _rss_bytes(pid):
+    try:
+        with open(f"/proc/{pid}/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return 0
+
+
+def current_rss_mb():
+    # Resident memory of this process and all its descendants right now, or
+    # None without /proc (macOS, Windows).
+    if not os.path.exists("/proc/self/statm"):
+        return None
+    pids, total = [os.getpid()], 0
+    while pids:
+        pid = pids.pop()
+        total += _rss_bytes(pid)
+        pids += _children(pid)
+    return round(total / 1024 / 1024, 1)
+
+
+# Samples current_rss_mb every `interval` seconds while a stage runs, so the
+# stage gets its own peak (worker processes included) instead of the
+# process-lifetime one.
+class RssSampler:
+    def __init__(self, interval=0.5):
+        self.interval = interval
+        self.first = self.last = self.peak = current_rss_mb()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        if self.first is not None:
+            self._thread = threading.Thread(target=self._sample, daemon=True)
+            self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._measure()
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            self._measure()
+
+    def _measure(self):
+        self.last = current_rss_mb()
+        self.peak = max(self.peak, self.last)
+
+    def growth_mb(self):
+        if self.first is None:
+            return None
+        return round(self.last - self.first, 1)
+
+
+# Beam counters are named "<stage>.<measure>" in the table's namespace, e.g.
+# ("return_fact", "extract.rows"); RunMetrics.record_pipeline files them
+# under that table and stage, *_ms counters as *_seconds. Stages are
+# extract, transform, stage_load, merge and keys.
+def counter(table_name, stage, measure):
+    return Metrics.counter(table_name, f"{stage}.{measure}")
+
+
+# A timed stage counts with its wall time, otherwise with what the Beam
+# counters and BigQuery jobs measured for it.
+def _stage_seconds(entry):
+    if "wall_seconds" in entry:
+        return entry["wall_seconds"]
+    return sum(
+        entry.get(name, 0)
+        for name in ("fetch_seconds", "busy_seconds", "write_seconds", "load_seconds", "job_seconds")
+    )
+
+
+def _job_seconds(job):
+    if job.started is None or job.ended is None:
+        return None
+    return round((job.ended - job.started).total_seconds(), 3)
+
+
+# Wall time, rows, bytes and job statistics per table and stage of one run,
+# plus run-wide stages such as a shared extraction pipeline or key
+# maintenance. report() adds the slowest tables and the tables that got
+# markedly slower than in the previous report. write_report also keeps each
+# table's last own extraction pipeline time, which longest_first orders
+# tables by.
+class RunMetrics:
+    def __init__(self, store, prefix="run_reports"):
+        self.store = store
+        self.prefix = prefix
+        self.run_id = None
+        self.started_at = None
+        self.tables = {}
+        self.stages = {}
+        self._lock = threading.Lock()
+
+    def start(self, run_id):
+        self.run_id = run_id
+        self.started_at = datetime.now()
+        self.tables = {}
+        self.stages = {}
+
+    def record(self, table_name, stage, **values):
+        # Numbers add up across calls (e.g. several shards or retries),
+        # except peaks, which keep the maximum.
+        with self._lock:
+            target = self.stages if table_name is None else self.tables.setdefault(table_name, {})
+            entry = target.setdefault(stage, {})
+            for name, value in values.items():
+                if value is None:
+                    continue
+                if name.startswith("peak_") and name in entry:
+                    entry[name] = max(entry[name], value)
+                elif isinstance(value, (int, float)) and name in entry:
+                    entry[name] += value
+                else:
+                    entry[name] = value
+
+    @contextmanager
+    def stage(self, table_name, stage):
+        """Times the block as `stage` of table_name, or of the whole run when table_name is None,
+        and records its peak and growth of resident memory."""
+        started = time.perf_counter()
+        sampler = RssSampler()
+        try:
+            with sampler:
+                yield
+        finally:
+            self.record(
+                table_name,
+                stage,
+                wall_seconds=round(time.perf_counter() - started, 3),
+                peak_rss_mb=sampler.peak,
+                rss_growth_mb=sampler.growth_mb(),
+            )
+
+    def record_pipeline(self, result, tables):
+        query = result.metrics().query(MetricsFilter().with_namespaces(tables))
+        for metric in query["counters"]:
+            stage, _, measure = metric.key.metric.name.partition(".")
+            value = metric.committed if metric.committed is not None else metric.attempted
+            if measure.endswith("_ms"):
+                measure, value = measure[:-3] + "_seconds", round(value / 1000, 3)
+            self.record(metric.key.metric.namespace, stage, **{measure: value})
+
+    def record_load_job(self, table_name, job):
+        self.record(
+            table_name,
+            "stage_load",
+            load_seconds=_job_seconds(job),
+            loaded_rows=job.output_rows,
+            loaded_bytes=job.output_bytes,
+            input_files=job.input_files,
+            input_file_bytes=job.input_file_bytes,
+        )
+
+    def record_merge_job(self, table_name, job):
+        self.record(
+            table_name,
+            "merge",
+            job_id=job.job_id,
+            job_seconds=_job_seconds(job),
+            total_bytes_processed=job.total_bytes_processed,
+            total_bytes_billed=job.total_bytes_billed,
+            slot_millis=job.slot_millis,
+            affected_rows=job.num_dml_affected_rows,
+        )
+
+    def table_seconds(self, table_name):
+        return round(sum(map(_stage_seconds, self.tables.get(table_name, {}).values())), 3)
+
+    def report(self, previous=None, regression_ratio=1.5, regression_min_seconds=10):
+        finished_at = datetime.now()
+        totals = {table_name: self.table_seconds(table_name) for table_name in self.tables}
+        previous_totals = (previous or {}).get("table_seconds", {})
+        regressions = [
+            {"table": table_name, "seconds": seconds, "previous_seconds": previous_totals[table_name]}
+            for table_name, seconds in totals.items()
+            if table_name in previous_totals
+            and seconds >= regression_min_seconds
+            and seconds >= regression_ratio * previous_totals[table_name]
+        ]
+        return {
+            "run_id": self.run_id,
+            "started_at": self.started_at,
+            "finished_at": finished_at,
+            "wall_seconds": round((finished_at - self.started_at).total_seconds(), 3),
+            "peak_rss_mb": peak_rss_mb(),
+            "peak_children_rss_mb": peak_rss_mb("children"),
+            "stages": self.stages,
+            "tables": self.tables,
+            "table_seconds": totals,
+            "slowest_tables": sorted(totals, key=totals.get, reverse=True)[:5],
+            "regressions": regressions,
+            "previous_run_id": (previous or {}).get("run_id"),
+        }
+
+    def update_history(self, report):
+        # Only tables that ran their own pipeline have an extraction wall
+        # time; a shared pipeline's is the run's, and load and merge times
+        # do not depend on the order tables are extracted in.
+        name = f"{self.prefix}/table_history.json"
+        history = self.store.read(name, default={})
+        for table_name, stages in report["tables"].items():
+            extract = stages.get("extract", {})
+            if "wall_seconds" in extract:
+                history[table_name] = {
+                    "extract_seconds": extract["wall_seconds"],
+                    "rows": extract.get("rows"),
+                    "run_id": self.run_id,
+                }
+        self.store.write(name, history)
+
+    def longest_first(self, tables):
+        # Tables without history are assumed to be as slow as the slowest
+        # known one, so they are not left to the end either.
+        history = self.store.read(f"{self.prefix}/table_history.json", default={})
+        expected = {
+            table_name: history[table_name]["extract_seconds"]
+            for table_name in tables
+            if "extract_seconds" in history.get(table_name, {})
+        }
+        unknown = max(expected.values(), default=0)
+        return sorted(tables, key=lambda table_name: expected.get(table_name, unknown), reverse=True)
+
+    def write_report(self):
+        latest = f"{self.prefix}/latest.json"
+        report = self.report(previous=self.store.read(latest, default=None))
+        self.store.write(f"{self.prefix}/{self.run_id}.json", report)
+        self.store.write(latest, report)
+        self.update_history(report)
+        print(
+            f"Run report {self.prefix}/{self.run_id}.json: {report['wall_seconds']:.0f}s, "
+            f"slowest {', '.join(report['slowest_tables'])}",
+            flush=True,
+        )
+        for regression in report["regressions"]:
+            print(
+                f"{regression['table']} took {regression['seconds']:.0f}s, "
+                f"{regression['previous_seconds']:.0f}s in the previous run",
+                flush=True,
+            )
+        return report
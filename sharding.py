@@ -0,0 +1,86 @@
+from sqlalchemy import text
+
+from bigquery_schemas import schemas
+
+# Tables holding the full key space of each shard key column.
+KEY_SOURCES = {
+    "work_id": "work",
+    "user_id": "library_user",
+    "author_id": "author",
+    "publisher_id": "publisher",
+    "subject_id": "subject",
+}
+
+# Fact tables are sampled from the OLTP table that drives them, so quantile
+# boundaries follow the actual row distribution rather than the key space.
+FACT_SOURCES = {
+    ("return_fact", "user_id"): "loan",
+    ("rating_fact", "user_id"): "rating",
+    ("rating_fact", "work_id"): "rating",
+    ("listing_fact", "user_id"): "listing",
+    ("listing_fact", "work_id"): "listing",
+}
+
+
+def shard_key(table_name):
+    for field in schemas[table_name]:
+        if field.description and "PK" in field.description and field.name in KEY_SOURCES:
+            return field.name
+    return None
+
+
+def minmax_boundaries(conn, source, key, shards):
+    lo, hi = conn.execute(text(f"SELECT MIN({key}), MAX({key}) FROM {source}")).one()
+    if lo is None:
+        return []
+    step = (hi - lo + 1) / shards
+    return sorted({lo + int(step * i) for i in range(1, shards)} - {lo})
+
+
+def quantile_boundaries(conn, source, key, shards, sample_percent=1.0):
+    fractions = ", ".join(str(i / shards) for i in range(1, shards))
+    boundaries = conn.execute(
+        text(
+            f"""
+            SELECT percentile_disc(ARRAY[{fractions}]::float8[]) WITHIN GROUP (ORDER BY {key})
+            FROM {source} TABLESAMPLE SYSTEM ({sample_percent})
+            """
+        )
+    ).scalar()
+    # Small tables can come back from TABLESAMPLE empty.
+    if not boundaries or boundaries[0] is None:
+        return minmax_boundaries(conn, source, key, shards)
+    return sorted(set(boundaries))
+
+
+def get_boundaries(conn, table_name, key, shards, strategy="minmax", sample_percent=1.0):
+    source = FACT_SOURCES.get((table_name, key), KEY_SOURCES[key])
+    if strategy == "quantiles":
+        return quantile_boundaries(conn, source, key, shards, sample_percent)
+    if strategy == "minmax":
+        return minmax_boundaries(conn, source, key, shards)
+    raise ValueError(f"Unknown shard strategy {strategy}")
+
+
+# query is (sql, params); every middle range runs the same statement text
+# with different :shard_lo/:shard_hi values.
+def shard_queries(query, key, boundaries):
+    if not boundaries:
+        return [query]
+    sql, params = query
+    bounds = [None, *boundaries, None]
+    sharded = []
+    for lo, hi in zip(bounds, bounds[1:]):
+        if lo is None:
+            condition = f"({key} < :shard_hi OR {key} IS NULL)"
+        elif hi is None:
+            condition = f"{key} >= :shard_lo"
+        else:
+            condition = f"{key} >= :shard_lo AND {key} < :shard_hi"
+        shard_params = dict(params)
+        if lo is not None:
+            shard_params["shard_lo"] = lo
+        if hi is not None:
+            shard_params["shard_hi"] = hi
+        sharded.append((f"SELECT * FROM ({sql}) AS shard WHERE {condition}", shard_params))
+    return sharded
@@ -0,0 +1,45 @@
+import json
+import os
+
+from google.cloud import storage
+from google.cloud.exceptions import NotFound
+
+
+# Small JSON documents the ETL keeps between runs. GcsJsonStore is what the
+# scheduled runs use; LocalJsonStore keeps the same documents in a directory
+# so runs can be tested without GCS.
+class GcsJsonStore:
+    def __init__(self, bucket, prefix=""):
+        self.bucket = bucket
+        self.prefix = prefix
+
+    def read(self, name, default=None):
+        try:
+            blob = storage.Blob(f"{self.prefix}{name}", self.bucket)
+            return json.loads(blob.download_as_text())
+        except (NotFound, ValueError):
+            return default
+
+    def write(self, name, value):
+        blob = storage.Blob(f"{self.prefix}{name}", self.bucket)
+        blob.upload_from_string(json.dumps(value, indent=2, default=str), content_type="application/json")
+
+
+class LocalJsonStore:
+    def __init__(self, directory):
+        self.directory = directory
+
+    def read(self, name, default=None):
+        try:
+            with open(os.path.join(self.directory, name), encoding="utf-8") as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return default
+
+    def write(self, name, value):
+        path = os.path.join(self.directory, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(value, f, indent=2, default=str)
+        os.replace(tmp_path, path)
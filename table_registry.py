@@ -0,0 +1,77 @@
+from datetime import date, datetime
+
+import queries
+from bigquery_schemas import schemas
+
+
+def to_timestamp(value):
+    # Watermarks and start dates are kept as strings; "infinity" is the open
+    # upper bound of a regular run.
+    if value == "infinity":
+        return datetime.max
+    if isinstance(value, datetime):
+        return value
+    if isinstance(value, date):
+        return datetime(value.year, value.month, value.day)
+    return datetime.fromisoformat(value)
+
+
+# One extracted table: its query with :name bind parameters, the names of
+# the parameters it takes and the BigQuery schema it is staged and merged
+# with. `variants` are alternative formulations of the same rows (e.g.
+# return_fact's "sweep"), `raw_query` the query for DataPipeline(query_mode="raw").
+class TableSpec:
+    def __init__(self, name, query, params=(), schema=None, variants=None, raw_query=None, raw_variants=None):
+        self.name = name
+        self.query = query
+        self.params = tuple(params)
+        self.schema = schema if schema is not None else schemas[name]
+        self.variants = variants or {}
+        self.raw_query = raw_query
+        self.raw_variants = raw_variants or {}
+
+    def sql(self, variant=None, raw=False):
+        if raw and self.raw_query is not None:
+            return self.raw_variants.get(variant, self.raw_query)
+        return self.variants.get(variant, self.query)
+
+    def bind(self, values):
+        return {name: values[name] for name in self.params}
+
+
+TABLES = {}
+
+
+def register(name, query, params=(), schema=None, **options):
+    spec = TableSpec(name, query, params, schema, **options)
+    # Everything downstream (Arrow, Parquet, MERGE, keys) looks schemas up by
+    # table name.
+    schemas.setdefault(name, spec.schema)
+    TABLES[name] = spec
+    return spec
+
+
+register("work", queries.work, ("start_date", "active_work_ids"))
+register("user", queries.user, ("start_date",), raw_query=queries.raw_user)
+register("publisher", queries.publisher, ("start_date", "active_work_ids"))
+register("author", queries.author, ("start_date", "active_work_ids"))
+register("work_author", queries.work_author, ("start_date", "active_work_ids"))
+register("subject", queries.subject, ("start_date",))
+register("language", queries.language, ("start_date",))
+register("date", queries.date, ("start_date", "end_date"), raw_query=queries.raw_date)
+register("medium", queries.medium)
+register("listing_type", queries.listing_type)
+register(
+    "rating_fact", queries.rating_fact, ("start_date", "end_date"), raw_query=queries.raw_rating_fact
+)
+register(
+    "listing_fact", queries.listing_fact, ("start_date", "end_date"), raw_query=queries.raw_listing_fact
+)
+register(
+    "return_fact",
+    queries.return_fact,
+    ("start_date", "end_date"),
+    variants={"sweep": queries.return_fact_sweep},
+    raw_query=queries.raw_return_fact,
+    raw_variants={"sweep": queries.raw_return_fact_sweep},
+)
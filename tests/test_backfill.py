@@ -0,0 +1,56 @@
+from datetime import date
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from arrow_schemas import to_record_batch
+from backfill import month_windows
+from warehouse import DuckDbWarehouse
+
+
+def rating(user_id, work_id, score, date_id):
+    return {"user_id": user_id, "work_id": work_id, "score": score, "date_id": date_id}
+
+
+def write(tmp_path, name, rows):
+    path = str(tmp_path / f"{name}.parquet")
+    pq.write_table(pa.Table.from_batches([to_record_batch(rows, "rating_fact")]), path)
+    return path
+
+
+def test_month_windows_end_at_the_end_date():
+    assert month_windows(date(2024, 1, 15), date(2024, 4, 10), months=2) == [
+        ("2024-01-15", "2024-03-01"),
+        ("2024-03-01", "2024-04-10"),
+    ]
+
+
+def test_load_windows_keeps_the_latest_window_of_each_key(tmp_path):
+    warehouse = DuckDbWarehouse(dataset="test")
+    warehouse.create_datasets()
+    warehouse.prepare_tables(["rating_fact"])
+    january = [
+        write(tmp_path, "january_1", [rating(1, 1, 3, 20240110)]),
+        write(tmp_path, "january_2", [rating(2, 1, 4, 20240111)]),
+    ]
+    # Reader 1 re-rates work 1 in March; February is empty.
+    march = [write(tmp_path, "march", [rating(1, 1, 5, 20240301), rating(3, 2, 1, 20240302)])]
+
+    job = warehouse.load_windows("rating_fact", [january, [], march])
+    assert job.output_rows == 3
+    assert job.input_files == 3
+    warehouse.merge("rating_fact")
+
+    assert sorted(warehouse.execute(
+        f"SELECT user_id, work_id, score, date_id FROM {warehouse.table_id('rating_fact')}"
+    )) == [(1, 1, 5, 20240301), (2, 1, 4, 20240111), (3, 2, 1, 20240302)]
+
+
+def test_load_windows_without_files_empties_staging(tmp_path):
+    warehouse = DuckDbWarehouse(dataset="test")
+    warehouse.create_datasets()
+    warehouse.prepare_tables(["rating_fact"])
+    warehouse.load_files("rating_fact", [write(tmp_path, "old", [rating(1, 1, 3, 20240110)])])
+
+    assert warehouse.load_windows("rating_fact", [[], []]) is None
+    assert warehouse.execute(f"SELECT COUNT(*) FROM {warehouse.table_id('rating_fact', staging=True)}") == [(0,)]
@@ -0,0 +1,76 @@
+from datetime import date, datetime
+
+import pytest
+from sqlalchemy import text
+
+import queries
+from calendar_dimension import calendar_row, calendar_rows, date_id, from_date_id, missing_calendar_rows
+
+
+def ids(rows):
+    return [row["date_id"] for row in rows]
+
+
+def no_gaps(lo, hi):
+    raise AssertionError("a contiguous table must not be read")
+
+
+def test_calendar_row():
+    assert calendar_row(date(2024, 11, 3)) == {
+        "year": 2024,
+        "month": "November 2024",
+        "quarter": "Q4 2024",
+        "date": date(2024, 11, 3),
+        "date_id": 20241103,
+    }
+
+
+def test_date_id_round_trip():
+    assert date_id(date(2024, 2, 29)) == 20240229
+    assert from_date_id(20240229) == date(2024, 2, 29)
+
+
+def test_calendar_rows_skip_loaded_days():
+    rows = calendar_rows(date(2024, 2, 27), date(2024, 3, 2), loaded_ids={20240229})
+    assert ids(rows) == [20240227, 20240228, 20240301, 20240302]
+
+
+def test_empty_table_gets_every_day():
+    rows = missing_calendar_rows(date(2024, 1, 1), date(2024, 1, 3), (None, None, 0), no_gaps)
+    assert ids(rows) == [20240101, 20240102, 20240103]
+
+
+def test_contiguous_table_only_gets_the_days_outside_it():
+    # 2024-01-03..2024-01-05 are loaded.
+    rows = missing_calendar_rows(date(2024, 1, 1), date(2024, 1, 7), (20240103, 20240105, 3), no_gaps)
+    assert ids(rows) == [20240101, 20240102, 20240106, 20240107]
+
+
+def test_up_to_date_table_gets_nothing():
+    assert missing_calendar_rows(date(2024, 1, 1), date(2024, 1, 5), (20231201, 20240105, 36), no_gaps) == []
+
+
+def test_table_with_gaps_reads_the_loaded_ids_of_the_range():
+    requested = []
+
+    def loaded_ids(lo, hi):
+        requested.append((lo, hi))
+        return iter([20240102, 20240104])
+
+    # 2024-01-01..2024-01-05 with 01-02 and 01-04 loaded: 2 days for a
+    # range of 5 means gaps.
+    rows = missing_calendar_rows(date(2024, 1, 1), date(2024, 1, 5), (20240102, 20240104, 2), loaded_ids)
+    assert ids(rows) == [20240101, 20240103, 20240105]
+    assert requested == [(20240101, 20240105)]
+
+
+@pytest.mark.parametrize("day", [date(2024, 1, 1), date(2024, 2, 29), date(2023, 9, 30), date(2024, 12, 31)])
+def test_calendar_row_matches_the_date_query(pg_conn, day):
+    for table_name, column in (("loan", "loaned_at"), ("rating", "rated_at"), ("listing", "listed_at")):
+        pg_conn.execute(text(f"CREATE TABLE {table_name} ({column} TIMESTAMP)"))
+    pg_conn.execute(text("INSERT INTO loan VALUES (:at)"), {"at": datetime(day.year, day.month, day.day, 12)})
+
+    rows = pg_conn.execute(
+        text(queries.date), {"start_date": datetime(1900, 1, 1), "end_date": datetime.max}
+    ).mappings().all()
+    assert [dict(row) for row in rows] == [calendar_row(day)]
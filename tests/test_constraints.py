@@ -0,0 +1,39 @@
+from constraints import CATALOG_NAME, ensure_constraints, expected_constraints
+from state_store import LocalJsonStore
+
+
+# Records when each statement is submitted and when its job is waited for.
+class Client:
+    def __init__(self):
+        self.events = []
+
+    def query(self, statement):
+        if "INFORMATION_SCHEMA" in statement:
+            return Job(self, None, [])
+        self.events.append(("submit", statement))
+        return Job(self, statement)
+
+
+class Job:
+    def __init__(self, client, statement, rows=None):
+        self.client = client
+        self.statement = statement
+        self.rows = rows
+
+    def result(self):
+        if self.statement is not None:
+            self.client.events.append(("done", self.statement))
+        return self.rows
+
+
+def test_foreign_keys_wait_for_the_primary_keys(tmp_path):
+    client = Client()
+    store = LocalJsonStore(str(tmp_path))
+    ensure_constraints(client, store, "project.dataset")
+
+    submitted = [statement for event, statement in client.events if event == "submit"]
+    first_fk = next(i for i, (event, statement) in enumerate(client.events) if "FOREIGN KEY" in statement)
+    pks_done = [i for i, (event, statement) in enumerate(client.events) if event == "done" and "PRIMARY KEY" in statement]
+    assert any("PRIMARY KEY" in statement for statement in submitted)
+    assert max(pks_done) < first_fk
+    assert sorted(store.read(CATALOG_NAME)) == sorted(dict(expected_constraints("project.dataset")))
@@ -0,0 +1,101 @@
+from decimal import Decimal
+
+import pytest
+from sqlalchemy import text
+
+import queries
+from benchmarks.synthetic import SCHEMA
+from derivations import derive, raw_record_batch
+from table_registry import TABLES, to_timestamp
+
+# Ages around today's birthday, a leap day, NULLs and a gender outside the
+# mapping.
+SOURCE_ROWS = [
+    "INSERT INTO library_user (user_id, first_name, last_name, gender, birthday) VALUES"
+    " (1, 'Ann', 'Lee', 'f', CURRENT_DATE - INTERVAL '30 years'),"
+    " (2, 'Bo', NULL, NULL, CURRENT_DATE - INTERVAL '13 years' + INTERVAL '1 day'),"
+    " (3, NULL, 'Cy', 'x', NULL),"
+    " (4, 'Di', 'Ng', 'm', DATE '2000-02-29'),"
+    " (5, 'Ed', 'Ong', 'n', CURRENT_DATE - INTERVAL '50 years' + INTERVAL '1 day')",
+    "INSERT INTO lang (language_id, lang_name, speakers) VALUES ('eng', 'English', 1500000000)",
+    "INSERT INTO publisher (publisher_id, publisher_name) VALUES (1, 'Publisher 1')",
+    "INSERT INTO work (work_id, title, release_year, pages, weight, language_id, medium, publisher_id) VALUES"
+    " (1, 'Work 1', 2000, 100, 0.5, 'eng', 'PAPERBACK', 1),"
+    " (2, 'Work 2', NULL, 200, 0.5, 'eng', 'EBOOK', 1)",
+    "INSERT INTO inventory_item (item_id, work_id) VALUES (1, 1), (2, 1), (3, 2)",
+    "INSERT INTO loan (loan_id, item_id, user_id, loaned_at) VALUES"
+    " (1, 1, 1, '2024-01-05 10:00'),"
+    " (2, 2, 2, '2024-01-06 00:00'),"
+    " (3, 3, 3, '2024-02-01 00:00'),"
+    " (4, 1, 4, '2024-03-01 12:00'),"
+    " (5, 2, 5, '2024-12-31 23:00')",
+    "INSERT INTO loan_return (loan_id, returned_at) VALUES"
+    " (1, '2024-01-09 09:00'),"
+    " (2, '2024-01-20 23:59'),"
+    " (3, '2024-02-01 05:00'),"
+    " (4, '2024-03-02 11:59')",
+    "INSERT INTO rating (work_id, user_id, score, rated_at) VALUES"
+    " (1, 1, 5, '2024-01-10 08:00'),"
+    " (2, 2, 3, '2024-02-11 23:30'),"
+    " (1, 3, 1, '2024-02-12 00:00'),"
+    " (1, 4, 4, '2024-02-29 00:00')",
+    "INSERT INTO listing (work_id, user_id, reading_status, listed_at) VALUES"
+    " (1, 1, 'WANT_TO_READ', '2024-01-10 08:00'),"
+    " (2, 2, 'ALREADY_READ', '2024-04-30 23:59'),"
+    " (1, 4, 'CURRENTLY_READING', '2024-12-31 00:00'),"
+    " (2, 5, 'WANT_TO_READ', '2024-06-01 00:00')",
+]
+
+VALUES = {"start_date": to_timestamp("1900-01-01"), "end_date": to_timestamp("infinity")}
+
+
+@pytest.fixture
+def source(pg_conn):
+    for statement in SCHEMA + SOURCE_ROWS:
+        pg_conn.execute(text(statement))
+    return pg_conn
+
+
+def normalized(row):
+    # EXTRACT returns numerics.
+    return {
+        name: int(value) if isinstance(value, Decimal) and value == int(value) else value
+        for name, value in row.items()
+    }
+
+
+def sql_rows(conn, table_name, variant):
+    spec = TABLES[table_name]
+    result = conn.execute(text(spec.sql(variant)), spec.bind(VALUES))
+    return [normalized(row) for row in result.mappings()]
+
+
+def derived_rows(conn, table_name, variant, columns):
+    spec = TABLES[table_name]
+    result = conn.execute(text(spec.sql(variant, raw=True)), spec.bind(VALUES))
+    batch = raw_record_batch(list(result.keys()), [tuple(row) for row in result])
+    today = conn.execute(text("SELECT CURRENT_DATE")).scalar()
+    enum_maps = {}
+    for type_name, label, sort_order in conn.execute(text(queries.enum_labels)):
+        enum_maps.setdefault(type_name, {})[label] = int(sort_order)
+    return [
+        {name: row[name] for name in columns}
+        for row in derive(batch, table_name, today, enum_maps).to_pylist()
+    ]
+
+
+@pytest.mark.parametrize(
+    "table_name, variant",
+    [
+        ("user", None),
+        ("date", None),
+        ("rating_fact", None),
+        ("listing_fact", None),
+        ("return_fact", None),
+        ("return_fact", "sweep"),
+    ],
+)
+def test_derived_columns_match_the_sql(source, table_name, variant):
+    expected = sql_rows(source, table_name, variant)
+    assert expected
+    assert sorted(derived_rows(source, table_name, variant, expected[0]), key=repr) == sorted(expected, key=repr)
@@ -0,0 +1,36 @@
+import pyarrow.parquet as pq
+
+from arrow_schemas import to_record_batch
+from file_sink import WriteParquetFiles
+
+
+def rating(user_id):
+    return {"user_id": user_id, "work_id": 1, "score": 3, "date_id": 20240110}
+
+
+def write(tmp_path, elements, row_group_size):
+    sink = WriteParquetFiles("rating_fact", str(tmp_path), row_group_size=row_group_size)
+    sink.setup()
+    sink.start_bundle()
+    for element in elements:
+        sink.process(element)
+    return [value.value for value in sink.finish_bundle()]
+
+
+def row_groups(path):
+    metadata = pq.ParquetFile(path).metadata
+    return [metadata.row_group(i).num_rows for i in range(metadata.num_row_groups)]
+
+
+def test_small_batches_fill_whole_row_groups(tmp_path):
+    batches = [to_record_batch([rating(7 * i + j) for j in range(7)], "rating_fact") for i in range(10)]
+    (path,) = write(tmp_path, batches, row_group_size=20)
+    assert row_groups(path) == [20, 20, 20, 10]
+    assert sorted(pq.read_table(path).column("user_id").to_pylist()) == list(range(70))
+
+
+def test_rows_and_batches_share_row_groups(tmp_path):
+    elements = [rating(0), to_record_batch([rating(1), rating(2)], "rating_fact"), rating(3), rating(4)]
+    (path,) = write(tmp_path, elements, row_group_size=3)
+    assert row_groups(path) == [3, 2]
+    assert sorted(pq.read_table(path).column("user_id").to_pylist()) == [0, 1, 2, 3, 4]
@@ -0,0 +1,37 @@
+from fingerprints import FingerprintStore
+from warehouse import DuckDbWarehouse
+
+
+def warehouse(path):
+    warehouse = DuckDbWarehouse(str(path), dataset="test")
+    warehouse.create_datasets()
+    return warehouse
+
+
+def remembered(store):
+    return store.lookup("user", ["1"])
+
+
+def test_fingerprints_survive_reopening_the_warehouse(tmp_path):
+    store = FingerprintStore(str(tmp_path / "fingerprints.db"))
+    first = warehouse(tmp_path / "warehouse.duckdb")
+    store.check_target("user", first.table_identity("user"))
+    store.stage("run1", "user", [("1", "hash")])
+    store.commit("run1", "user")
+    first.connection.close()
+
+    second = warehouse(tmp_path / "warehouse.duckdb")
+    store.check_target("user", second.table_identity("user"))
+    assert remembered(store) == {"1": "hash"}
+
+
+def test_recreated_table_forgets_its_fingerprints(tmp_path):
+    store = FingerprintStore(str(tmp_path / "fingerprints.db"))
+    target = warehouse(tmp_path / "warehouse.duckdb")
+    store.check_target("user", target.table_identity("user"))
+    store.stage("run1", "user", [("1", "hash")])
+    store.commit("run1", "user")
+
+    target.execute(f"DROP TABLE {target.table_id('user')}")
+    store.check_target("user", target.table_identity("user"))
+    assert remembered(store) == {}
@@ -0,0 +1,121 @@
+import threading
+from concurrent.futures import Future
+
+import pytest
+
+from merge_scheduler import MergeScheduler, dependency_graph
+
+
+class Job:
+    def __init__(self, table_name, error=None):
+        self.table_name = table_name
+        self.error = error
+
+    def result(self):
+        if self.error is not None:
+            raise self.error
+        return self
+
+
+class Warehouse:
+    # submit() for the scheduler: records the order tables are merged in and
+    # fails a table's first `failures[table]` attempts.
+    def __init__(self, failures=None):
+        self.failures = dict(failures or {})
+        self.attempts = []
+        self.merged = []
+        self.lock = threading.Lock()
+
+    def submit(self, table_name):
+        with self.lock:
+            self.attempts.append(table_name)
+            if self.failures.get(table_name, 0) > 0:
+                self.failures[table_name] -= 1
+                return Job(table_name, RuntimeError(f"{table_name} broke"))
+            self.merged.append(table_name)
+        return Job(table_name)
+
+
+def scheduler(warehouse, **options):
+    return MergeScheduler(warehouse.submit, backoff=0, **options)
+
+
+def test_dependency_graph_only_orders_tables_of_the_run():
+    graph = dependency_graph(["return_fact", "user", "subject"])
+    assert graph == {"return_fact": {"user"}, "user": set(), "subject": set()}
+
+
+def test_dimensions_are_merged_before_their_facts():
+    warehouse = Warehouse()
+    tables = ["return_fact", "rating_fact", "work", "user", "date", "subject"]
+    done = scheduler(warehouse, max_concurrency=3).run(tables)
+
+    assert set(done) == set(tables)
+    order = warehouse.merged.index
+    for fact in ("return_fact", "rating_fact"):
+        for dimension in ("work", "user", "date"):
+            assert order(dimension) < order(fact)
+
+
+def test_extra_dependencies_order_names_outside_the_schemas():
+    warehouse = Warehouse()
+    scheduler(warehouse, dependencies={"monthly_loans": {"user", "work"}}).run(["monthly_loans", "user", "work"])
+    assert warehouse.merged[-1] == "monthly_loans"
+
+
+def test_on_merged_is_called_once_per_table():
+    merged = []
+    warehouse = Warehouse()
+    scheduler(warehouse, on_merged=lambda table_name, job: merged.append((table_name, job.table_name))).run(
+        ["user", "rating_fact"]
+    )
+    assert sorted(merged) == [("rating_fact", "rating_fact"), ("user", "user")]
+
+
+def test_failed_merge_is_retried():
+    warehouse = Warehouse(failures={"user": 1})
+    scheduler(warehouse, retries=1).run(["user"])
+    assert warehouse.attempts == ["user", "user"]
+
+
+def test_failure_skips_dependent_tables_and_raises():
+    warehouse = Warehouse(failures={"user": 2})
+    merged = []
+    with pytest.raises(RuntimeError) as raised:
+        scheduler(warehouse, retries=1, on_merged=lambda table_name, job: merged.append(table_name)).run(
+            ["user", "return_fact", "subject"]
+        )
+
+    assert "user: user broke" in str(raised.value)
+    assert "return_fact: skipped, user failed" in str(raised.value)
+    # Tables that do not depend on the failed one are still merged.
+    assert merged == ["subject"]
+    assert "return_fact" not in warehouse.attempts
+
+
+def test_table_waits_for_its_ready_future():
+    warehouse = Warehouse()
+    loaded = Future()
+    timer = threading.Timer(0.2, lambda: (warehouse.merged.append("loaded"), loaded.set_result(None)))
+    timer.start()
+    scheduler(warehouse).run(["user", "subject"], ready={"user": loaded})
+    timer.join()
+
+    assert warehouse.merged.index("loaded") < warehouse.merged.index("user")
+
+
+def test_failed_ready_future_fails_the_table_and_its_dependents():
+    warehouse = Warehouse()
+    loaded = Future()
+    loaded.set_exception(ValueError("load failed"))
+    with pytest.raises(RuntimeError) as raised:
+        scheduler(warehouse).run(["user", "return_fact", "subject"], ready={"user": loaded})
+
+    assert "user: load failed" in str(raised.value)
+    assert "return_fact: skipped" in str(raised.value)
+    assert warehouse.merged == ["subject"]
+
+
+def test_circular_dependencies_are_reported():
+    with pytest.raises(RuntimeError, match="Circular"):
+        scheduler(Warehouse(), dependencies={"a": {"b"}, "b": {"a"}}).run(["a", "b"])
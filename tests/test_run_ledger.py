@@ -0,0 +1,50 @@
+from connections import DsnConnectionFactory
+from main import DataPipeline
+from run_ledger import RunLedger
+from state_store import LocalJsonStore
+
+
+def test_unfinished_run_is_resumed_with_its_progress(tmp_path):
+    store = LocalJsonStore(str(tmp_path))
+    ledger = RunLedger(store)
+    ledger.start("20240101T000000", {"user": "2023-12-01", "rating_fact": "2023-12-01"}, {"user": "2024-01-01"})
+    ledger.mark("user", "extracted", "staged")
+    ledger.mark("user", "staged", "merged")
+
+    resumed = RunLedger(store)
+    run = resumed.resume()
+    assert run["run_id"] == "20240101T000000"
+    assert run["start_dates"] == {"user": "2023-12-01", "rating_fact": "2023-12-01"}
+    assert run["watermarks"] == {"user": "2024-01-01"}
+    assert run["tables"]["user"] == ["extracted", "staged", "merged"]
+    assert resumed.done("user", "merged")
+    assert resumed.pending(["user", "rating_fact"], "extracted") == ["rating_fact"]
+
+
+def test_finished_or_missing_run_is_not_resumed(tmp_path):
+    store = LocalJsonStore(str(tmp_path))
+    assert RunLedger(store).resume() is None
+
+    ledger = RunLedger(store)
+    ledger.start("20240101T000000", {"user": "2023-12-01"}, {})
+    ledger.finish()
+    assert RunLedger(store).resume() is None
+
+
+def test_pipeline_resumes_the_run_id_and_window(tmp_path):
+    store = LocalJsonStore(str(tmp_path))
+    RunLedger(store).start("20240101T000000", {"rating_fact": "2023-12-01"}, {"rating_fact": "2024-01-01 00:00:00"})
+
+    # No source database is needed: a resumed run reuses its stored window
+    # instead of probing new watermarks.
+    pipeline = DataPipeline(
+        offline=True,
+        connection_factory=DsnConnectionFactory("postgresql+pg8000://nobody@localhost/unused"),
+        state_store=store,
+    )
+    start_dates, watermarks = pipeline.start_run()
+
+    assert pipeline.run_id == "20240101T000000"
+    assert start_dates == {"rating_fact": "2023-12-01"}
+    assert watermarks == {"rating_fact": "2024-01-01 00:00:00"}
+    assert pipeline.metrics.run_id == "20240101T000000"
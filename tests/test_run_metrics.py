@@ -0,0 +1,37 @@
+import subprocess
+import sys
+import time
+
+import pytest
+
+from run_metrics import RunMetrics, current_rss_mb
+from state_store import LocalJsonStore
+
+pytestmark = pytest.mark.skipif(current_rss_mb() is None, reason="needs /proc")
+
+ALLOCATE = "import time; block = bytearray(200 * 1024 * 1024); time.sleep(1.5)"
+
+
+@pytest.fixture
+def metrics(tmp_path):
+    metrics = RunMetrics(LocalJsonStore(str(tmp_path)))
+    metrics.start("run")
+    return metrics
+
+
+def test_stage_peak_includes_child_processes(metrics):
+    baseline = current_rss_mb()
+    with metrics.stage("user", "extract"):
+        subprocess.run([sys.executable, "-c", ALLOCATE], check=True)
+    assert metrics.tables["user"]["extract"]["peak_rss_mb"] >= baseline + 150
+
+
+def test_stage_peak_is_the_stage_own(metrics):
+    with metrics.stage("user", "extract"):
+        # Held across a few samples.
+        block = bytearray(200 * 1024 * 1024)
+        time.sleep(1.5)
+        del block
+    with metrics.stage("work", "extract"):
+        pass
+    assert metrics.tables["work"]["extract"]["peak_rss_mb"] < metrics.tables["user"]["extract"]["peak_rss_mb"] - 150
@@ -0,0 +1,73 @@
+import pytest
+import sqlalchemy
+from sqlalchemy import text
+
+from sharding import get_boundaries, minmax_boundaries, shard_key, shard_queries
+
+QUERY = ("SELECT user_id, score FROM rating WHERE score >= :min_score", {"min_score": 2})
+
+
+@pytest.fixture
+def conn():
+    # shard_queries only wraps the query, so any SQL database will do.
+    engine = sqlalchemy.create_engine("sqlite://")
+    with engine.connect() as conn:
+        conn.execute(text("CREATE TABLE rating (user_id INTEGER, score INTEGER)"))
+        conn.execute(
+            text("INSERT INTO rating VALUES (:user_id, :score)"),
+            [{"user_id": user_id, "score": user_id % 5} for user_id in range(1, 101)]
+            + [{"user_id": None, "score": 4}, {"user_id": None, "score": 1}],
+        )
+        yield conn
+
+
+def rows(conn, query):
+    sql, params = query
+    return sorted(conn.execute(text(sql), params).all(), key=repr)
+
+
+def test_shard_key_is_the_first_shardable_pk_column():
+    assert shard_key("return_fact") == "user_id"
+    assert shard_key("work") == "work_id"
+    assert shard_key("date") is None
+
+
+def test_without_boundaries_the_query_is_unchanged():
+    assert shard_queries(QUERY, "user_id", []) == [QUERY]
+
+
+def test_shards_partition_the_rows(conn):
+    shards = shard_queries(QUERY, "user_id", [27, 52, 77])
+    assert len(shards) == 4
+
+    results = [rows(conn, shard) for shard in shards]
+    assert sum(map(len, results)) == len(rows(conn, QUERY))
+    assert sorted((row for result in results for row in result), key=repr) == rows(conn, QUERY)
+    # NULL keys go to the first shard, each boundary to the shard above it.
+    assert (None, 4) in results[0]
+    assert max(user_id for user_id, _ in results[0] if user_id is not None) == 24
+    assert min(user_id for user_id, _ in results[1]) == 27
+    assert min(user_id for user_id, _ in results[3]) == 77
+
+
+def test_middle_shards_share_one_statement(conn):
+    shards = shard_queries(QUERY, "user_id", [25, 50, 75])
+    assert shards[1][0] == shards[2][0]
+    assert shards[1][1] == {"min_score": 2, "shard_lo": 25, "shard_hi": 50}
+    assert shards[0][1] == {"min_score": 2, "shard_hi": 25}
+    assert shards[3][1] == {"min_score": 2, "shard_lo": 75}
+
+
+def test_minmax_boundaries_split_the_key_range(conn):
+    assert minmax_boundaries(conn, "rating", "user_id", 4) == [26, 51, 76]
+    assert get_boundaries(conn, "rating_fact", "user_id", 4) == [26, 51, 76]
+
+
+def test_minmax_boundaries_of_an_empty_table(conn):
+    conn.execute(text("DELETE FROM rating"))
+    assert minmax_boundaries(conn, "rating", "user_id", 4) == []
+
+
+def test_unknown_strategy_is_rejected(conn):
+    with pytest.raises(ValueError):
+        get_boundaries(conn, "rating_fact", "user_id", 4, strategy="hash")
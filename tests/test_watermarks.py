@@ -0,0 +1,42 @@
+from datetime import datetime
+
+import pytest
+from sqlalchemy import text
+
+from state_store import LocalJsonStore
+from watermarks import WatermarkStore, probe_earliest, probe_watermark
+
+
+@pytest.fixture
+def events(pg_conn):
+    for table_name, column in (("loan", "loaned_at"), ("rating", "rated_at"), ("listing", "listed_at")):
+        pg_conn.execute(text(f"CREATE TABLE {table_name} ({column} TIMESTAMP)"))
+    pg_conn.execute(text("INSERT INTO loan VALUES ('2024-01-05 10:00'), ('2024-02-01 09:30'), (NULL)"))
+    pg_conn.execute(text("INSERT INTO rating VALUES ('2024-03-01 12:00'), ('2023-12-31 23:00')"))
+    return pg_conn
+
+
+def test_probe_watermark_returns_the_newest_value_after_start(events):
+    assert probe_watermark(events, "return_fact", "2024-01-01") == datetime(2024, 2, 1, 9, 30)
+
+
+def test_probe_watermark_is_none_without_new_rows(events):
+    assert probe_watermark(events, "return_fact", "2024-02-01 09:30:00") is None
+    assert probe_watermark(events, "listing_fact", "1900-01-01") is None
+
+
+def test_probe_watermark_takes_the_newest_of_several_sources(events):
+    # "date" follows loans, ratings and listings; the empty listing table
+    # does not hide the others.
+    assert probe_watermark(events, "date", "2024-01-01") == datetime(2024, 3, 1, 12, 0)
+
+
+def test_probe_earliest_takes_the_oldest_of_several_sources(events):
+    assert probe_earliest(events, "date") == datetime(2023, 12, 31, 23, 0)
+
+
+def test_watermark_store_keeps_other_tables(tmp_path):
+    store = WatermarkStore(LocalJsonStore(str(tmp_path)))
+    store.save({"user": datetime(2024, 1, 1), "work": "2024-01-02 00:00:00"})
+    store.save({"user": datetime(2024, 2, 1)})
+    assert store.load() == {"user": "2024-02-01 00:00:00", "work": "2024-01-02 00:00:00"}
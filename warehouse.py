@@ -0,0 +1,444 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from uuid import uuid4
+
+from google.cloud import bigquery
+from google.cloud.exceptions import NotFound
+
+import db_secrets as secrets
+from bigquery_schemas import clustering, partitioning, schemas
+from constraints import ensure_constraints, forget_table
+from file_sink import load_files
+
+
+def key_fields(table_name):
+    return [field.name for field in schemas[table_name] if field.description and "PK" in field.description]
+
+
+def merge_sql(target, source, columns, keys, quote=str, on_extra=""):
+    # Upserts source into target on keys.
+    on_clause = " AND ".join(f"TARGET.{quote(name)} = SOURCE.{quote(name)}" for name in keys)
+    set_clause = ", ".join(f"{quote(name)} = SOURCE.{quote(name)}" for name in columns)
+    insert_fields = ", ".join(quote(name) for name in columns)
+    insert_values = ", ".join(f"SOURCE.{quote(name)}" for name in columns)
+    return f"""
+        MERGE INTO {target} AS TARGET
+        USING {source} AS SOURCE
+        ON {on_clause}{on_extra}
+        WHEN MATCHED THEN
+            UPDATE SET {set_clause}
+        WHEN NOT MATCHED THEN
+            INSERT ({insert_fields})
+            VALUES ({insert_values})
+        """
+
+
+def latest_rows_sql(sources, columns, keys, quote=str):
+    # One row per key out of sources listed oldest first; the row from the
+    # latest source that has the key wins.
+    fields = ", ".join(quote(name) for name in columns)
+    union = "\n            UNION ALL\n            ".join(
+        f"SELECT {fields}, {window} AS _window FROM {source}" for window, source in enumerate(sources)
+    )
+    partition = ", ".join(quote(name) for name in keys)
+    return f"""
+        SELECT {fields}
+        FROM (
+            SELECT *, ROW_NUMBER() OVER (PARTITION BY {partition} ORDER BY _window DESC) AS _row
+            FROM (
+            {union}
+            ) AS WINDOWS
+        ) AS RANKED
+        WHERE _row = 1
+        """
+
+
+# Where DataPipeline loads its staged Parquet files and merges them. Each
+# table has a target and a staging table of the same schema (from
+# bigquery_schemas), load_files replaces the staging table's rows and merge
+# upserts them into the target on the PK columns. load_files and merge return
+# jobs with .result() and the statistics RunMetrics records. Staging tables
+# are kept between runs: every load replaces their rows.
+class BigQueryWarehouse:
+    def __init__(self, client, state_store, project=secrets.PROJECT_ID, dataset=secrets.INSTANCE_ID, max_workers=8):
+        self.client = client
+        self.state_store = state_store
+        self.project = project
+        self.dataset = dataset
+        self.max_workers = max_workers
+        # Ids of tables known to exist with the right clustering, so
+        # get_or_create_table does not ask BigQuery again, and their
+        # creation times.
+        self.ready = set()
+        self.created = {}
+
+    def table_id(self, table_name, staging=False):
+        return f"{self.project}.{self.dataset}{'_staging' if staging else ''}.{table_name}"
+
+    def create_datasets(self):
+        self.client.create_dataset(dataset=self.dataset, exists_ok=True)
+        self.client.create_dataset(dataset=f"{self.dataset}_staging", exists_ok=True)
+
+    def prepare_tables(self, tables):
+        # One listing per dataset instead of a get_table per table; only
+        # missing tables and those whose clustering or partitioning has to be
+        # checked cost a call each, and those calls run concurrently.
+        listed = {
+            f"{item.project}.{item.dataset_id}.{item.table_id}": item.created
+            for dataset in (self.dataset, f"{self.dataset}_staging")
+            for item in self.client.list_tables(dataset)
+        }
+        self.created.update(listed)
+        todo = []
+        for table_name in tables:
+            for staging in (False, True):
+                checked = staging or (table_name not in clustering and table_name not in partitioning)
+                if checked and self.table_id(table_name, staging) in listed:
+                    self.ready.add(self.table_id(table_name, staging))
+                else:
+                    todo.append((table_name, staging))
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            list(executor.map(lambda args: self.get_or_create_table(*args), todo))
+
+    def get_or_create_table(self, table_name, staging=False):
+        table_id = self.table_id(table_name, staging)
+        if table_id in self.ready:
+            return table_id
+        try:
+            table = self.client.get_table(table_id)
+            if not staging and table.clustering_fields != clustering.get(table_name):
+                table.clustering_fields = clustering.get(table_name)
+                self.client.update_table(table, ["clustering_fields"])
+            if not staging and table_name in partitioning and table.range_partitioning is None:
+                print(f"{table_id} is not partitioned, recreate it to partition on "
+                      f"{partitioning[table_name].field}", flush=True)
+        except NotFound:
+            table = bigquery.Table(table_id, schema=schemas[table_name])
+            if not staging:
+                table.range_partitioning = partitioning.get(table_name)
+                table.clustering_fields = clustering.get(table_name)
+            table = self.client.create_table(table)
+            if not staging:
+                forget_table(self.state_store, table_name)
+        self.created[table_id] = table.created
+        self.ready.add(table_id)
+        return table_id
+
+    def table_identity(self, table_name):
+        # Changes when the target table is dropped and created again.
+        table_id = self.get_or_create_table(table_name)
+        if self.created.get(table_id) is None:
+            self.created[table_id] = self.client.get_table(table_id).created
+        return self.created[table_id].isoformat()
+
+    def load_files(self, table_name, files):
+        table_id = self.table_id(table_name, staging=True)
+        if not files:
+            # The staging table still holds the rows of the last load, which
+            # the MERGE must not see again.
+            self.truncate_staging_table(table_name)
+            return None
+        return load_files(self.client, table_id, table_name, files)
+
+    def load_windows(self, table_name, windows):
+        # Replaces the staged rows with the files of several windows (lists
+        # of files, oldest first), keeping each key's row from the latest
+        # window, so one MERGE can apply them all. The files are read as
+        # external tables, one per window.
+        windows = [files for files in windows if files]
+        if not windows:
+            self.truncate_staging_table(table_name)
+            return None
+        table_definitions = {}
+        for window, files in enumerate(windows):
+            external = bigquery.ExternalConfig(bigquery.SourceFormat.PARQUET)
+            external.source_uris = files
+            external.schema = schemas[table_name]
+            table_definitions[f"window_{window}"] = external
+        job_config = bigquery.QueryJobConfig(
+            destination=self.get_or_create_table(table_name, staging=True),
+            write_disposition=bigquery.WriteDisposition.WRITE_TRUNCATE,
+            table_definitions=table_definitions,
+        )
+        return self.client.query(
+            latest_rows_sql(
+                list(table_definitions),
+                [field.name for field in schemas[table_name]],
+                key_fields(table_name),
+            ),
+            job_config=job_config,
+        )
+
+    def merge(self, table_name):
+        print(f"Merging {table_name}s...", flush=True)
+        pk_fields = key_fields(table_name)
+        return self.client.query(merge_sql(
+            f"`{self.table_id(table_name)}`",
+            f"`{self.table_id(table_name, staging=True)}`",
+            [field.name for field in schemas[table_name]],
+            pk_fields,
+            on_extra=self.get_partition_predicate(table_name, pk_fields),
+        ))
+
+    def quoted_table_id(self, table_name, staging=False):
+        return f"`{self.table_id(table_name, staging)}`"
+
+    def refresh_rollup(self, rollup):
+        print(f"Refreshing {rollup.name}...", flush=True)
+        if self.table_id(rollup.name) not in self.ready:
+            for statement in rollup.create(self.quoted_table_id, cluster=True):
+                self.client.query(statement).result()
+            # Created before <name>_rows was clustered.
+            rows = self.client.get_table(self.table_id(rollup.rows_name))
+            cluster_by = key_fields(rollup.fact)[:4]
+            if rows.clustering_fields != cluster_by:
+                rows.clustering_fields = cluster_by
+                self.client.update_table(rows, ["clustering_fields"])
+            self.ready.add(self.table_id(rollup.name))
+        # A failed statement rolls the whole transaction back.
+        statements = ["BEGIN TRANSACTION", *rollup.refresh(self.quoted_table_id), "COMMIT TRANSACTION"]
+        return self.client.query(";\n".join(statements))
+
+    def get_partition_predicate(self, table_name, pk_fields):
+        # Restricting TARGET to the staged partition range lets BigQuery prune
+        # the MERGE. That is only safe when the partition column is part of the
+        # key: otherwise a staged row may match a target row in a partition
+        # outside the range (e.g. a re-rating on a new day) and be inserted twice.
+        spec = partitioning.get(table_name)
+        if spec is None or spec.field not in pk_fields:
+            return ""
+        bounds = next(iter(self.client.query(
+            f"SELECT MIN({spec.field}) AS lo, MAX({spec.field}) AS hi "
+            f"FROM `{self.table_id(table_name, staging=True)}`"
+        ).result()))
+        if bounds.lo is None:
+            return ""
+        return f" AND TARGET.{spec.field} BETWEEN {bounds.lo} AND {bounds.hi}"
+
+    def date_id_bounds(self):
+        row = next(iter(self.client.query(
+            f"SELECT MIN(date_id) AS lo, MAX(date_id) AS hi, COUNT(DISTINCT date_id) AS days "
+            f"FROM `{self.get_or_create_table('date')}`"
+        ).result()))
+        return row.lo, row.hi, row.days
+
+    def loaded_date_ids(self, lo, hi):
+        rows = self.client.query(
+            f"SELECT date_id FROM `{self.get_or_create_table('date')}` WHERE date_id BETWEEN {int(lo)} AND {int(hi)}"
+        ).result()
+        return (row.date_id for row in rows)
+
+    def truncate_staging_table(self, table_name):
+        # Empties the table in place: a dropped and recreated table can lose
+        # the first rows streamed into it while BigQuery still sees the old one.
+        table_id = self.get_or_create_table(table_name, staging=True)
+        self.client.query(f"TRUNCATE TABLE `{table_id}`").result()
+
+    def truncate_staging_tables(self, tables):
+        # One script job for every table prepare_tables just set up.
+        table_ids = [self.get_or_create_table(table_name, staging=True) for table_name in tables]
+        if table_ids:
+            self.client.query("".join(f"TRUNCATE TABLE `{table_id}`;\n" for table_id in table_ids)).result()
+
+    def set_keys(self):
+        ensure_constraints(self.client, self.state_store, f"{self.project}.{self.dataset}")
+
+
+def quote(name):
+    return f'"{name}"'
+
+
+DUCKDB_TYPES = {
+    "INTEGER": "BIGINT",
+    "FLOAT": "DOUBLE",
+    "STRING": "VARCHAR",
+    "DATE": "DATE",
+    "BOOLEAN": "BOOLEAN",
+}
+
+JOB_STATISTICS = (
+    "output_rows",
+    "output_bytes",
+    "input_files",
+    "input_file_bytes",
+    "total_bytes_processed",
+    "total_bytes_billed",
+    "slot_millis",
+    "num_dml_affected_rows",
+)
+
+
+# DuckDB statements run synchronously, so the job is done when it is
+# returned; statistics DuckDB does not have stay None.
+class DuckDbJob:
+    def __init__(self, started, **statistics):
+        self.job_id = f"duckdb_{uuid4().hex}"
+        self.started = started
+        self.ended = datetime.now()
+        for name in JOB_STATISTICS:
+            setattr(self, name, statistics.get(name))
+
+    def result(self):
+        return self
+
+
+# The same tables and upsert semantics in a local DuckDB database file, for
+# development runs and for profiling loads and merges without BigQuery. The
+# target and staging tables live in the schemas <dataset> and
+# <dataset>_staging. Only local staging paths can be loaded.
+class DuckDbWarehouse:
+    def __init__(self, path=":memory:", dataset=secrets.INSTANCE_ID):
+        import duckdb
+
+        self.path = path
+        self.dataset = dataset
+        self.connection = duckdb.connect(path)
+        self._lock = threading.Lock()
+
+    def table_id(self, table_name, staging=False):
+        return f'"{self.dataset}{"_staging" if staging else ""}"."{table_name}"'
+
+    def execute(self, sql, params=None):
+        # A cursor per statement: merges of different tables run on
+        # MergeScheduler's threads.
+        with self._lock:
+            cursor = self.connection.cursor()
+        try:
+            return cursor.execute(sql, params).fetchall()
+        finally:
+            cursor.close()
+
+    def create_datasets(self):
+        self.execute(f'CREATE SCHEMA IF NOT EXISTS "{self.dataset}"')
+        self.execute(f'CREATE SCHEMA IF NOT EXISTS "{self.dataset}_staging"')
+
+    def prepare_tables(self, tables):
+        for table_name in tables:
+            self.get_or_create_table(table_name)
+            self.get_or_create_table(table_name, staging=True)
+
+    def get_or_create_table(self, table_name, staging=False):
+        columns = ", ".join(f'"{field.name}" {DUCKDB_TYPES[field.field_type]}' for field in schemas[table_name])
+        self.execute(f"CREATE TABLE IF NOT EXISTS {self.table_id(table_name, staging)} ({columns})")
+        return self.table_id(table_name, staging)
+
+    def load_files(self, table_name, files):
+        if not files:
+            self.truncate_staging_table(table_name)
+            return None
+        started = datetime.now()
+        columns = ", ".join(f'"{field.name}"' for field in schemas[table_name])
+        rows = self._replace_staged(table_name, f"SELECT {columns} FROM read_parquet(?)", [list(files)])
+        return DuckDbJob(
+            started,
+            output_rows=rows,
+            input_files=len(files),
+            input_file_bytes=sum(os.path.getsize(path) for path in files),
+        )
+
+    def load_windows(self, table_name, windows):
+        windows = [list(files) for files in windows if files]
+        if not windows:
+            self.truncate_staging_table(table_name)
+            return None
+        started = datetime.now()
+        sql = latest_rows_sql(
+            ["read_parquet(?)"] * len(windows),
+            [field.name for field in schemas[table_name]],
+            key_fields(table_name),
+            quote=quote,
+        )
+        files = [path for window in windows for path in window]
+        return DuckDbJob(
+            started,
+            output_rows=self._replace_staged(table_name, sql, windows),
+            input_files=len(files),
+            input_file_bytes=sum(os.path.getsize(path) for path in files),
+        )
+
+    def _replace_staged(self, table_name, select, params):
+        table_id = self.get_or_create_table(table_name, staging=True)
+        columns = ", ".join(f'"{field.name}"' for field in schemas[table_name])
+        with self._lock:
+            cursor = self.connection.cursor()
+        try:
+            # Replaces the staged rows like the BigQuery load's WRITE_TRUNCATE.
+            cursor.execute("BEGIN TRANSACTION")
+            cursor.execute(f"DELETE FROM {table_id}")
+            rows = cursor.execute(f"INSERT INTO {table_id} ({columns}) {select}", params).fetchone()[0]
+            cursor.execute("COMMIT")
+        except Exception:
+            cursor.execute("ROLLBACK")
+            raise
+        finally:
+            cursor.close()
+        return rows
+
+    def merge(self, table_name):
+        print(f"Merging {table_name}s...", flush=True)
+        started = datetime.now()
+        target = self.get_or_create_table(table_name)
+        # MERGE INTO needs DuckDB 1.4 or newer.
+        sql = merge_sql(
+            target,
+            self.table_id(table_name, staging=True),
+            [field.name for field in schemas[table_name]],
+            key_fields(table_name),
+            quote=quote,
+        )
+        return DuckDbJob(started, num_dml_affected_rows=self.execute(sql)[0][0])
+
+    def refresh_rollup(self, rollup):
+        print(f"Refreshing {rollup.name}...", flush=True)
+        started = datetime.now()
+        for statement in rollup.create(self.table_id, quote):
+            self.execute(statement)
+        with self._lock:
+            cursor = self.connection.cursor()
+        try:
+            cursor.execute("BEGIN TRANSACTION")
+            # The first statement merges into the rollup itself.
+            rows = [cursor.execute(statement).fetchall() for statement in rollup.refresh(self.table_id, quote)][0]
+            cursor.execute("COMMIT")
+        except Exception:
+            cursor.execute("ROLLBACK")
+            raise
+        finally:
+            cursor.close()
+        return DuckDbJob(started, num_dml_affected_rows=rows[0][0])
+
+    def table_identity(self, table_name):
+        # table_oid changes whenever the file is reopened, so the identity is
+        # a UUID kept in the table's comment; a recreated table has none.
+        table_id = self.get_or_create_table(table_name)
+        (identity,) = self.execute(
+            "SELECT comment FROM duckdb_tables() WHERE schema_name = ? AND table_name = ?",
+            [self.dataset, table_name],
+        )[0]
+        if not identity:
+            identity = uuid4().hex
+            self.execute(f"COMMENT ON TABLE {table_id} IS '{identity}'")
+        return identity
+
+    def date_id_bounds(self):
+        return tuple(self.execute(
+            f"SELECT MIN(date_id), MAX(date_id), COUNT(DISTINCT date_id) FROM {self.get_or_create_table('date')}"
+        )[0])
+
+    def loaded_date_ids(self, lo, hi):
+        table_id = self.get_or_create_table("date")
+        return (date_id for (date_id,) in self.execute(f"SELECT date_id FROM {table_id} WHERE date_id BETWEEN ? AND ?", [lo, hi]))
+
+    def truncate_staging_table(self, table_name):
+        self.execute(f"DELETE FROM {self.get_or_create_table(table_name, staging=True)}")
+
+    def truncate_staging_tables(self, tables):
+        for table_name in tables:
+            self.truncate_staging_table(table_name)
+
+    def set_keys(self):
+        # The BigQuery keys are informational (NOT ENFORCED); DuckDB would
+        # enforce them, which the staging loads do not need.
+        pass
@@ -0,0 +1,55 @@
+from sqlalchemy import text
+
+from table_registry import to_timestamp
+
+DEFAULT_START = "1900-01-01"
+
+# Columns each table's query filters on with `> :start_date`. Tables that
+# are not listed (the enum dimensions) are cheap and extracted every run.
+WATERMARK_COLUMNS = {
+    "work": [("work", "modified_at")],
+    "user": [("library_user", "modified_at")],
+    "publisher": [("publisher", "modified_at")],
+    "author": [("author", "modified_at")],
+    "work_author": [("work_author", "added_at")],
+    "subject": [("subject", "modified_at")],
+    "language": [("lang", "modified_at")],
+    "date": [("loan", "loaned_at"), ("rating", "rated_at"), ("listing", "listed_at")],
+    "rating_fact": [("rating", "rated_at")],
+    "listing_fact": [("listing", "listed_at")],
+    "return_fact": [("loan", "loaned_at")],
+}
+
+
+class WatermarkStore:
+    def __init__(self, store, name="watermarks.json"):
+        self.store = store
+        self.name = name
+
+    def load(self):
+        return self.store.read(self.name, default={})
+
+    def save(self, watermarks):
+        current = self.load()
+        current.update({table: str(value) for table, value in watermarks.items()})
+        self.store.write(self.name, current)
+
+
+def probe_earliest(conn, table_name):
+    # The oldest value of the table's watermark columns, e.g. the first loan,
+    # rating or listing for "date"; None for an empty source.
+    probes = ", ".join(
+        f"(SELECT MIN({column}) FROM {source})" for source, column in WATERMARK_COLUMNS[table_name]
+    )
+    return conn.execute(text(f"SELECT LEAST({probes})")).scalar()
+
+
+def probe_watermark(conn, table_name, start_date):
+    # Returns the newest value past start_date, or None when the table has no
+    # new rows and can be skipped. With an index on the column this is a single
+    # index lookup instead of the full extraction query.
+    probes = ", ".join(
+        f"(SELECT MAX({column}) FROM {source} WHERE {column} > :start_date)"
+        for source, column in WATERMARK_COLUMNS[table_name]
+    )
+    return conn.execute(text(f"SELECT GREATEST({probes})"), {"start_date": to_timestamp(start_date)}).scalar()